@@ -0,0 +1,489 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк точек входа (run.py, calc_z_road.py, update_km.py) на локальном
+PostgreSQL/PostGIS с синтетическим проектом.
+
+Запуск:
+    bench/bench.py run --roads 10 --km 5 [--pg-bin /usr/lib/postgresql/X/bin]
+    bench/bench.py compare bench/results/A.json bench/results/B.json
+"""
+
+import datetime
+import json
+import optparse
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import psycopg2
+
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+RESULTS_DIR = os.path.join(BENCH_DIR, 'results')
+PROJECT = 'bench'
+DB_NAME = 'dorgis_' + PROJECT
+DB_USER = 'postgres'
+
+# Долгота/широта начала первой дороги и шаг между дорогами (градусы)
+LON0, LAT0, ROAD_STEP = 37.0, 55.0, 0.02
+# Градусов долготы в километре на широте LAT0 (приблизительно)
+DEG_PER_KM = 1 / 63.8
+
+
+def read_flag_conf():
+    """Считать параметры командной строки"""
+
+    parser = optparse.OptionParser(
+        usage='%prog run [options] | %prog compare BASE.json NEW.json',
+        description='Бенчмарк расчётов на синтетическом проекте'
+    )
+    parser.add_option(
+        '--pg-bin',
+        action='store', type=str, dest='pg_bin', default='',
+        help='Каталог с initdb/pg_ctl (по умолчанию из PATH)'
+    )
+    parser.add_option(
+        '--host',
+        action='store', type=str, dest='host', default='',
+        help='Использовать уже запущенный сервер вместо временного'
+    )
+    parser.add_option(
+        '--port',
+        action='store', type=int, dest='port', default=54329,
+        help='Порт сервера'
+    )
+    parser.add_option(
+        '--roads',
+        action='store', type=int, dest='roads', default=5,
+        help='Количество дорог'
+    )
+    parser.add_option(
+        '--km',
+        action='store', type=float, dest='km', default=5,
+        help='Длина каждой дороги, км'
+    )
+    parser.add_option(
+        '--tins-per-km',
+        action='store', type=int, dest='tins_per_km', default=2000,
+        help='Треугольников поверхности на км дороги'
+    )
+    parser.add_option(
+        '--objects',
+        action='store', type=int, dest='objects', default=200,
+        help='Объектов на таблицу и дорогу в editor.tbl_acad_objects'
+    )
+    parser.add_option(
+        '--tables',
+        action='store', type=int, dest='tables', default=10,
+        help='Количество таблиц объектов в схеме dorgis'
+    )
+    parser.add_option(
+        '--panoramas-per-km',
+        action='store', type=int, dest='panoramas_per_km', default=100,
+        help='Панорам на км дороги'
+    )
+    parser.add_option(
+        '--run-args',
+        action='store', type=str, dest='run_args', default='-a',
+        help='Ключи обработки для run.py'
+    )
+    parser.add_option(
+        '--jobs',
+        action='store', type=int, dest='jobs', default=1,
+        help='Значение --jobs для run.py и calc_z_road.py'
+    )
+    parser.add_option(
+        '--skip',
+        action='store', type=str, dest='skip', default='',
+        help='Не запускать точки входа (через запятую: run,z,km)'
+    )
+    parser.add_option(
+        '--keep',
+        action='store_true', dest='keep', default=False,
+        help='Не удалять временный кластер после бенчмарка'
+    )
+    parser.add_option(
+        '--threshold',
+        action='store', type=float, dest='threshold', default=10.0,
+        help='Допустимое падение производительности при сравнении, %'
+    )
+
+    return parser.parse_args()
+
+
+class Cluster(object):
+    """Временный кластер PostgreSQL (initdb + pg_ctl)"""
+
+    def __init__(self, pg_bin, port):
+        self.pg_bin = pg_bin
+        self.port = port
+        self.dir = tempfile.mkdtemp(prefix='dorgis_bench_')
+        self.data = os.path.join(self.dir, 'data')
+        # Соединение через unix-сокет в каталоге кластера
+        self.host = self.dir
+
+    def _bin(self, name):
+        return os.path.join(self.pg_bin, name) if self.pg_bin else name
+
+    def start(self):
+        subprocess.check_call(
+            [self._bin('initdb'), '-D', self.data, '-U', DB_USER,
+             '--auth=trust', '-E', 'UTF8'],
+            stdout=subprocess.DEVNULL
+        )
+        options = "-p %d -k %s -c listen_addresses='' -c fsync=off" % (
+            self.port, self.dir)
+        subprocess.check_call(
+            [self._bin('pg_ctl'), '-D', self.data, '-o', options,
+             '-l', os.path.join(self.dir, 'server.log'), '-w', 'start'],
+            stdout=subprocess.DEVNULL
+        )
+
+    def stop(self, keep=False):
+        subprocess.call(
+            [self._bin('pg_ctl'), '-D', self.data, '-m', 'fast', 'stop'],
+            stdout=subprocess.DEVNULL
+        )
+        if not keep:
+            shutil.rmtree(self.dir, ignore_errors=True)
+
+
+def connect(host, port, db_name):
+    connection = psycopg2.connect(host=host, port=port, user=DB_USER,
+                                  database=db_name)
+    connection.autocommit = True
+    return connection
+
+
+def create_project(host, port, options):
+    """Создать БД проекта со схемой и синтетическими данными"""
+
+    connection = connect(host, port, 'postgres')
+    cursor = connection.cursor()
+    cursor.execute('DROP DATABASE IF EXISTS %s' % DB_NAME)
+    cursor.execute('CREATE DATABASE %s' % DB_NAME)
+    connection.close()
+
+    connection = connect(host, port, DB_NAME)
+    cursor = connection.cursor()
+    cursor.execute(open(os.path.join(BENCH_DIR, 'schema.sql')).read())
+    generate(cursor, options)
+    cursor.execute('VACUUM ANALYZE')
+    connection.close()
+
+
+def generate(cursor, options):
+    """Заполнить проект синтетическими дорогами"""
+
+    # Вершина оси каждые 50 м
+    vertices = max(2, int(options.km * 20))
+    step = options.km * DEG_PER_KM / (vertices - 1)
+
+    # Оси дорог (M-координата появится после calc_z_road.py)
+    cursor.execute('''
+        INSERT INTO tbl_roads (road_code, name, geom, length_km, fmp, tmp)
+        SELECT r, 'Дорога ' || r,
+               ST_SetSRID(ST_MakeLine(array_agg(
+                   ST_MakePoint(%(lon)s + i * %(step)s,
+                                %(lat)s + r * %(road_step)s
+                                    + 0.0005 * sin(i / 10.0))
+                   ORDER BY i)), 4326),
+               %(km)s, 0, %(km)s
+        FROM generate_series(1, %(roads)s) r,
+             generate_series(0, %(vertices)s - 1) i
+        GROUP BY r
+    ''', {'lon': LON0, 'lat': LAT0, 'road_step': ROAD_STEP, 'step': step,
+          'km': options.km, 'roads': options.roads, 'vertices': vertices})
+
+    # Поверхности: треугольники вдоль оси, по одному потоку на дорогу
+    cursor.execute('''
+        INSERT INTO tbl_fname_road_code (fname, road_code)
+        SELECT 'road_' || r || '.las', r
+        FROM generate_series(1, %(roads)s) r
+    ''', {'roads': options.roads})
+    cursor.execute('''
+        INSERT INTO tbl_las_tin (fname, geom)
+        SELECT 'road_' || r || '.las',
+               ST_SetSRID(ST_MakePolygon(ST_MakeLine(ARRAY[
+                   ST_MakePoint(x, y, z), ST_MakePoint(x + d, y, z + 0.01),
+                   ST_MakePoint(x, y + d, z + 0.02), ST_MakePoint(x, y, z)
+               ])), 4326)
+        FROM (
+            SELECT r,
+                   %(lon)s + random() * %(len)s AS x,
+                   %(lat)s + r * %(road_step)s + (random() - 0.5) * 0.0003
+                       AS y,
+                   100 + random() AS z,
+                   0.00005 AS d
+            FROM generate_series(1, %(roads)s) r,
+                 generate_series(1, %(tins)s) i
+        ) AS t
+    ''', {'lon': LON0, 'lat': LAT0, 'road_step': ROAD_STEP,
+          'len': options.km * DEG_PER_KM, 'roads': options.roads,
+          'tins': int(options.tins_per_km * options.km)})
+
+    # Панорамы
+    cursor.execute('''
+        INSERT INTO tbl_panoram_road (road_code, geom)
+        SELECT r, ST_SetSRID(ST_MakePoint(
+                   %(lon)s + random() * %(len)s,
+                   %(lat)s + r * %(road_step)s + (random() - 0.5) * 0.0002
+               ), 4326)
+        FROM generate_series(1, %(roads)s) r,
+             generate_series(1, %(panoramas)s) i
+    ''', {'lon': LON0, 'lat': LAT0, 'road_step': ROAD_STEP,
+          'len': options.km * DEG_PER_KM, 'roads': options.roads,
+          'panoramas': int(options.panoramas_per_km * options.km)})
+
+    # Таблицы объектов dorgis с триггером привязки к км и входные данные
+    for k in range(1, options.tables + 1):
+        table = 'tbl_bench_%d' % k
+        cursor.execute('''
+            CREATE TABLE dorgis.%(table)s (
+                id serial PRIMARY KEY,
+                road_code integer,
+                km double precision,
+                geom geometry(Point, 4326)
+            );
+            CREATE INDEX ON dorgis.%(table)s (road_code);
+            CREATE TRIGGER bind_km BEFORE INSERT OR UPDATE
+                ON dorgis.%(table)s
+                FOR EACH ROW EXECUTE PROCEDURE dorgis.bind_km();
+            INSERT INTO dorgis.struct_db
+                (db_name, name, schema_name, type, always_show_all)
+            VALUES ('%(table)s', 'Бенчмарк %(k)s', 'dorgis', 5, false);
+        ''' % {'table': table, 'k': k})
+        cursor.execute('''
+            INSERT INTO dorgis.%(table)s (road_code, geom)
+            SELECT r, ST_SetSRID(ST_MakePoint(
+                       %%(lon)s + random() * %%(len)s,
+                       %%(lat)s + r * %%(road_step)s
+                   ), 4326)
+            FROM generate_series(1, %%(roads)s) r,
+                 generate_series(1, %%(objects)s) i
+        ''' % {'table': table},
+            {'lon': LON0, 'lat': LAT0, 'road_step': ROAD_STEP,
+             'len': options.km * DEG_PER_KM, 'roads': options.roads,
+             'objects': options.objects})
+        cursor.execute('''
+            INSERT INTO editor.tbl_acad_objects (road_code, table_name,
+                                                 acid, geom)
+            SELECT r::text, %(table)s, r || '-' || i,
+                   ST_SetSRID(ST_MakePoint(
+                       %(lon)s + random() * %(len)s,
+                       %(lat)s + r * %(road_step)s
+                   ), 4326)
+            FROM generate_series(1, %(roads)s) r,
+                 generate_series(1, %(objects)s) i
+        ''', {'table': table, 'lon': LON0, 'lat': LAT0,
+              'road_step': ROAD_STEP, 'len': options.km * DEG_PER_KM,
+              'roads': options.roads, 'objects': options.objects})
+
+
+def parse_log(logfile):
+    """Достать AMOUNT и STATUS из лога точки входа"""
+
+    result = {'amount': None, 'status': None}
+    try:
+        text = open(logfile).read()
+    except OSError:
+        return result
+    match = re.search(r'AMOUNT: (\d+)', text)
+    if match:
+        result['amount'] = int(match.group(1))
+    match = re.search(r'STATUS: (\w+)', text)
+    if match:
+        result['status'] = match.group(1)
+    return result
+
+
+def run_entry(name, args, workdir, env):
+    """Запустить точку входа и собрать её показатели"""
+
+    logfile = os.path.join(workdir, name + '.log')
+    command = [sys.executable, os.path.join(ROOT_DIR, name),
+               '--logfile', logfile] + args
+
+    time_start = time.perf_counter()
+    code = subprocess.call(command, env=env, cwd=workdir,
+                           stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL)
+    duration = time.perf_counter() - time_start
+
+    result = parse_log(logfile)
+    result['exit_code'] = code
+    result['duration'] = duration
+    result['throughput'] = (result['amount'] / duration
+                            if result['amount'] and duration else None)
+
+    metrics_file = os.path.splitext(logfile)[0] + '.metrics.json'
+    if os.path.exists(metrics_file):
+        result['stages'] = json.load(open(metrics_file)).get('stages', [])
+
+    return result
+
+
+def run_bench(options):
+    """Поднять сервер, создать проект, прогнать точки входа"""
+
+    cluster = None
+    host = options.host
+    if not host:
+        cluster = Cluster(options.pg_bin, options.port)
+        cluster.start()
+        host = cluster.host
+
+    workdir = tempfile.mkdtemp(prefix='dorgis_bench_run_')
+    try:
+        time_start = time.perf_counter()
+        create_project(host, options.port, options)
+        generate_time = time.perf_counter() - time_start
+
+        road_codes = ','.join(str(r) for r in range(1, options.roads + 1))
+
+        # Конфигурация для run.py во временном каталоге
+        conf_file = os.path.join(workdir, 'conf.json')
+        json.dump({
+            'server': host,
+            'db_name': DB_NAME,
+            'db_user': DB_USER,
+            'db_pass': '',
+            'road_codes': list(range(1, options.roads + 1)),
+            'cache_dir': os.path.join(workdir, 'cache'),
+        }, open(conf_file, 'w'))
+
+        env = dict(os.environ)
+        env['PGPORT'] = str(options.port)
+        env['DORGIS_CONF'] = conf_file
+
+        skip = options.skip.split(',') if options.skip else []
+        results = {}
+
+        # Порядок как в сервисе: ось -> перепривязка -> расчёты
+        if 'z' not in skip:
+            results['calc_z_road.py'] = run_entry(
+                'calc_z_road.py',
+                ['--project', PROJECT, '--server', host,
+                 '--road-codes', road_codes, '--km-beg', '0',
+                 '--jobs', str(options.jobs)],
+                workdir, env)
+        if 'km' not in skip:
+            results['update_km.py'] = run_entry(
+                'update_km.py',
+                ['--project', PROJECT, '--server', host,
+                 '--road-codes', road_codes],
+                workdir, env)
+        if 'run' not in skip:
+            results['run.py'] = run_entry(
+                'run.py',
+                ['--quiet', '--force', '--jobs', str(options.jobs)] +
+                options.run_args.split(),
+                workdir, env)
+    finally:
+        if cluster:
+            cluster.stop(options.keep)
+        if not options.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        'timestamp': datetime.datetime.now().isoformat(),
+        'revision': get_revision(),
+        'scale': {
+            'roads': options.roads,
+            'km': options.km,
+            'tins_per_km': options.tins_per_km,
+            'objects': options.objects,
+            'tables': options.tables,
+            'panoramas_per_km': options.panoramas_per_km,
+            'jobs': options.jobs,
+            'run_args': options.run_args,
+        },
+        'generate_time': generate_time,
+        'results': results,
+    }
+
+
+def get_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIR,
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save_results(data):
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    name = '%s_%s.json' % (
+        datetime.datetime.now().strftime('%Y%m%d_%H%M%S'),
+        data['revision'] or 'norev')
+    path = os.path.join(RESULTS_DIR, name)
+    json.dump(data, open(path, 'w'), ensure_ascii=False, indent=2)
+    return path
+
+
+def print_results(data):
+    for name, result in sorted(data['results'].items()):
+        throughput = result['throughput']
+        print('%-16s %-8s %8.1f с %10s м/с' % (
+            name, result['status'] or 'ERROR', result['duration'],
+            '%.1f' % throughput if throughput else '-'))
+        for stage in result.get('stages', []):
+            print('    %-20s %8.1f с (БД %.1f с)' % (
+                stage['name'], stage['duration'], stage['db']))
+
+
+def compare(base_file, new_file, threshold):
+    """Сравнить два результата, вернуть True при регрессии"""
+
+    base = json.load(open(base_file))
+    new = json.load(open(new_file))
+    if base['scale'] != new['scale']:
+        print('ВНИМАНИЕ: масштабы проектов различаются')
+
+    regression = False
+    for name in sorted(set(base['results']) & set(new['results'])):
+        old_t = base['results'][name]['throughput']
+        new_t = new['results'][name]['throughput']
+        if not old_t or not new_t:
+            print('%-16s нет данных' % name)
+            continue
+        change = (new_t - old_t) / old_t * 100
+        mark = ''
+        if change < -threshold:
+            mark = '  РЕГРЕССИЯ'
+            regression = True
+        print('%-16s %10.1f -> %10.1f м/с (%+.1f%%)%s' % (
+            name, old_t, new_t, change, mark))
+
+        old_stages = dict((s['name'], s) for s in
+                          base['results'][name].get('stages', []))
+        for stage in new['results'][name].get('stages', []):
+            old = old_stages.get(stage['name'])
+            if old and old['duration']:
+                print('    %-20s %8.1f -> %8.1f с (%+.1f%%)' % (
+                    stage['name'], old['duration'], stage['duration'],
+                    (stage['duration'] - old['duration']) /
+                    old['duration'] * 100))
+
+    return regression
+
+
+if __name__ == '__main__':
+    options, args = read_flag_conf()
+
+    if args[:1] == ['compare'] and len(args) == 3:
+        sys.exit(1 if compare(args[1], args[2], options.threshold) else 0)
+    elif args[:1] == ['run']:
+        data = run_bench(options)
+        print_results(data)
+        print('Результат: ' + save_results(data))
+    else:
+        print(__doc__.strip(), file=sys.stderr)
+        sys.exit(2)
@@ -0,0 +1,123 @@
+-- Синтетическая схема проекта для бенчмарков.
+-- Повторяет только то, что используют run.py, calc_z_road.py и update_km.py;
+-- функции БД упрощены, но выполняют сопоставимый объём работы.
+
+CREATE EXTENSION IF NOT EXISTS postgis;
+
+CREATE SCHEMA IF NOT EXISTS editor;
+CREATE SCHEMA IF NOT EXISTS dorgis;
+
+CREATE TABLE tbl_roads (
+    id serial PRIMARY KEY,
+    road_code integer NOT NULL,
+    name text,
+    geom geometry,
+    geomz geometry,
+    length_km double precision,
+    fmp double precision DEFAULT 0,
+    tmp double precision
+);
+CREATE INDEX ON tbl_roads (road_code);
+CREATE INDEX ON tbl_roads USING gist (geom);
+
+CREATE TABLE tbl_fname_road_code (
+    fname text NOT NULL,
+    road_code integer NOT NULL
+);
+CREATE INDEX ON tbl_fname_road_code (road_code);
+
+CREATE TABLE tbl_las_tin (
+    id serial PRIMARY KEY,
+    fname text NOT NULL,
+    geom geometry(PolygonZ, 4326)
+);
+CREATE INDEX ON tbl_las_tin (fname);
+CREATE INDEX ON tbl_las_tin USING gist (geom);
+
+CREATE TABLE tbl_panoram_road (
+    id serial PRIMARY KEY,
+    road_code integer NOT NULL,
+    geom geometry(Point, 4326),
+    km_beg double precision
+);
+CREATE INDEX ON tbl_panoram_road (road_code, id);
+CREATE INDEX ON tbl_panoram_road USING gist (geom);
+
+CREATE TABLE editor.tbl_acad_objects (
+    id serial PRIMARY KEY,
+    road_code text NOT NULL,
+    table_name text NOT NULL,
+    acid text,
+    geom geometry
+);
+CREATE INDEX ON editor.tbl_acad_objects (road_code, table_name);
+
+CREATE TABLE dorgis.struct_db (
+    db_name text,
+    name text,
+    schema_name text,
+    type integer,
+    always_show_all boolean
+);
+
+CREATE TABLE dorgis.dict_roads (
+    road_code integer PRIMARY KEY,
+    name text,
+    lenght double precision
+);
+
+-- UTM-зона по долготе центра геометрии
+CREATE FUNCTION utmzone(g geometry) RETURNS integer AS $$
+    SELECT 32600 + floor((ST_X(ST_Centroid(g)) + 180) / 6)::integer + 1
+$$ LANGUAGE sql IMMUTABLE;
+
+-- 3D ось: Z берётся из ближайшего треугольника поверхности
+CREATE FUNCTION get_linez_from_line(g geometry, rc integer)
+RETURNS geometry AS $$
+    SELECT ST_MakeLine(array_agg(
+        ST_MakePoint(ST_X(p.geom), ST_Y(p.geom), coalesce((
+            SELECT ST_Z(ST_PointN(ST_ExteriorRing(t.geom), 1))
+            FROM tbl_las_tin t
+            WHERE t.fname IN (
+                SELECT fname FROM tbl_fname_road_code WHERE road_code = rc
+            )
+            ORDER BY t.geom <-> p.geom
+            LIMIT 1
+        ), 0))
+        ORDER BY p.path))
+    FROM ST_DumpPoints(ST_Force2D(g)) p
+$$ LANGUAGE sql STABLE;
+
+CREATE FUNCTION ST_AddMeasure_Meters(g geometry, fmp double precision,
+                                     tmp double precision)
+RETURNS geometry AS $$
+    SELECT ST_AddMeasure(ST_Force2D(g), fmp * 1000, tmp * 1000)
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE FUNCTION ST_InterpolatePoint_Meters(line geometry, point geometry)
+RETURNS double precision AS $$
+    SELECT ST_InterpolatePoint(line, point) / 1000
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE FUNCTION update_road_measure(rc integer) RETURNS void AS $$
+    UPDATE tbl_roads
+    SET length_km = ST_Length(geom::geography) / 1000,
+        fmp = 0,
+        tmp = ST_Length(geom::geography) / 1000,
+        geom = ST_AddMeasure_Meters(geom, 0, ST_Length(geom::geography) / 1000)
+    WHERE road_code = rc
+$$ LANGUAGE sql;
+
+-- Триггер привязки объекта к километражу (как в боевых таблицах dorgis)
+CREATE FUNCTION dorgis.bind_km() RETURNS trigger AS $$
+BEGIN
+    NEW.km := (
+        SELECT ST_InterpolatePoint_Meters(r.geom, NEW.geom)
+        FROM tbl_roads r
+        WHERE r.road_code = NEW.road_code
+        ORDER BY r.geom <-> NEW.geom
+        LIMIT 1
+    );
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""
+Проверки без БД: двоичный формат COPY (numeric, EWKB), разбиение дороги
+на окна и преобразование параметров подготовленных операторов.
+Код возврата 1, если какая-то проверка не прошла.
+
+Запуск:
+    bench/selfcheck.py
+"""
+
+import decimal
+import os
+import struct
+import sys
+import traceback
+
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, ROOT_DIR)
+
+
+def decode_numeric(data):
+    """Разобрать numeric в двоичном формате COPY (как это делает сервер)"""
+    ndigits, weight, sign, dscale = struct.unpack('>hhHh', data[:8])
+    if sign == 0xC000:
+        return decimal.Decimal('NaN')
+    groups = struct.unpack('>%dh' % ndigits, data[8:])
+    value = decimal.Decimal(0)
+    for i, group in enumerate(groups):
+        value += decimal.Decimal(group).scaleb(4 * (weight - i))
+    if sign == 0x4000:
+        value = -value
+    return value.quantize(decimal.Decimal(1).scaleb(-dscale))
+
+
+def check_numeric():
+    from conf import _encode_numeric
+
+    # Значение -> (ndigits, weight, sign, dscale, цифры по основанию 10000)
+    known = {
+        '0': (0, 0, 0, 0, ()),
+        '12345.678': (3, 1, 0, 3, (1, 2345, 6780)),
+        '-0.001': (1, -1, 0x4000, 3, (10,)),
+        '1000000': (1, 1, 0, 0, (100,)),
+        '0.00001234': (1, -2, 0, 8, (1234,)),
+    }
+    for value, (ndigits, weight, sign, dscale, groups) in known.items():
+        expected = struct.pack('>hhHh', ndigits, weight, sign, dscale) + \
+            struct.pack('>%dh' % len(groups), *groups)
+        actual = _encode_numeric(value)
+        assert actual == expected, '%s: %r != %r' % (value, actual, expected)
+
+    assert struct.unpack('>hhHh', _encode_numeric('NaN'))[2] == 0xC000
+
+    for value in ('3.14159', '-271828.1828', '99999999.9999', '0.5', '1e-7',
+                  '123456789012345678.9', 0.1, -2.5, 7, 10 ** 12):
+        decoded = decode_numeric(_encode_numeric(value))
+        source = decimal.Decimal(repr(value) if isinstance(value, float)
+                                 else value)
+        assert decoded == source, '%s: %s' % (value, decoded)
+
+
+def check_geometry():
+    from conf import _encode_geometry
+
+    # Готовый EWKB передаётся как есть
+    data = bytes.fromhex('0101000020e6100000000000000000f03f0000000000000040')
+    assert _encode_geometry(data, 32637) == data
+    assert _encode_geometry(data.hex(), 32637) == data
+
+    try:
+        from shapely.geometry import Point
+    except ImportError:
+        print('  shapely не установлен, EWKB из геометрии не проверен')
+        return
+
+    point = _encode_geometry(Point(1, 2), 32637)
+    order = '<' if point[0:1] == b'\x01' else '>'
+    geom_type, srid = struct.unpack(order + 'II', point[1:9])
+    assert geom_type == 1 | 0x20000000, hex(geom_type)
+    assert srid == 32637, srid
+    assert struct.unpack(order + 'dd', point[9:]) == (1.0, 2.0)
+
+    # Без SRID - обычный WKB
+    assert _encode_geometry(Point(1, 2), None)[1:5] == \
+        struct.pack(order + 'I', 1)
+
+
+class FakeCursor(object):
+    """Курсор, возвращающий одну заданную строку"""
+
+    def __init__(self, row):
+        self.row = row
+
+    def execute(self, sql, params=None):
+        pass
+
+    def fetchone(self):
+        return self.row
+
+
+def check_windows():
+    from common import plan_windows
+
+    def plan(m_from, m_to, window=1000, overlap=200):
+        return plan_windows(FakeCursor({'m_from': m_from, 'm_to': m_to}),
+                            1, window, overlap)
+
+    assert plan(0, 2300) == [(0, 1000, 0, 1200),
+                             (1000, 2000, 800, 2200),
+                             (2000, 2300, 1800, 2300)], plan(0, 2300)
+    # Короткий хвост присоединяется к последнему окну
+    assert plan(0, 2200) == [(0, 1000, 0, 1200),
+                             (1000, 2200, 800, 2200)], plan(0, 2200)
+    assert plan(500, 700) == [(500, 700, 500, 700)], plan(500, 700)
+    assert plan_windows(FakeCursor(None), 1, 1000, 200) == []
+    assert plan_windows(FakeCursor({'m_from': None, 'm_to': None}),
+                        1, 1000, 200) == []
+
+    # Основные интервалы стыкуются и покрывают дорогу
+    for m_from, m_to, window, overlap in ((0, 12345.6, 1000, 200),
+                                          (150, 151, 1000, 0),
+                                          (0, 5000, 1000, 0)):
+        windows = plan(m_from, m_to, window, overlap)
+        assert windows[0][0] == m_from and windows[-1][1] == m_to
+        for (c_from, c_to, e_from, e_to), following in \
+                zip(windows, windows[1:] + [None]):
+            assert e_from <= c_from < c_to <= e_to
+            assert m_from <= e_from and e_to <= m_to
+            if following:
+                assert following[0] == c_to
+
+
+def check_convert():
+    import queries
+
+    assert queries.convert('SELECT 1') == ('SELECT 1', [])
+    assert queries.convert(
+        'SELECT %(a)s + %(b)s, %(a)s LIKE \'x%%\'') == \
+        ('SELECT $1 + $2, $1 LIKE \'x%\'', ['a', 'b'])
+    text, order = queries.convert('WHERE code = ANY(%(codes)s)')
+    assert (text, order) == ('WHERE code = ANY($1)', ['codes'])
+    name = queries.statement_name('x', 'SELECT 1')
+    assert name == queries.statement_name('x', 'SELECT 1')
+    assert name != queries.statement_name('x', 'SELECT 2')
+
+
+CHECKS = [
+    ('numeric', check_numeric),
+    ('geometry', check_geometry),
+    ('windows', check_windows),
+    ('convert', check_convert),
+]
+
+
+def main():
+    failed = 0
+    for name, check in CHECKS:
+        try:
+            check()
+        except Exception:
+            failed += 1
+            print('%-10s FAIL' % name)
+            traceback.print_exc(file=sys.stdout)
+        else:
+            print('%-10s ok' % name)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Время запуска: импорт модулей, который выполняют точки входа до начала
+работы, для разных наборов этапов (каждый замер - отдельный процесс).
+
+Запуск:
+    bench/startup.py [--repeat 10]
+"""
+
+import ast
+import optparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+
+
+def run_imports():
+    """Код импорта модулей, которые run.py импортирует при загрузке"""
+    with open(os.path.join(ROOT_DIR, 'run.py'), encoding='utf-8') as f:
+        tree = ast.parse(f.read())
+    modules = set()
+    # Только импорты верхнего уровня: импорт внутри веток (common_json
+    # при --acad) выполняется лишь в своём режиме
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            modules.update(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module:
+            modules.add(node.module)
+    return 'import ' + ', '.join(sorted(modules))
+
+
+RUN = run_imports()
+
+# Сценарий -> код, выполняемый в новом интерпретаторе
+SCENARIOS = [
+    # calc_z_road.py и update_km.py: нужен только get_amount
+    ('common', 'import common'),
+    # run.py -p: только продольный профиль
+    ('latprofile', "import common; common.get_handler('latprofile')"),
+    # run.py --rut: только колейность
+    ('rut', "import common; common.get_handler('rut')"),
+    # Все модули расчётов (как при импорте common до ленивой загрузки)
+    ('all', 'import common; common.preload_stages()'),
+    # Импорты run.py при загрузке + этапы режима
+    ('run.py -p', RUN + "; import common; common.get_handler('latprofile')"),
+    ('run.py -a', RUN + '; import common; common.preload_stages()'),
+    ('run.py acad', RUN + '; import common_json'),
+]
+
+
+def read_flag_conf():
+    """Считать параметры командной строки"""
+
+    parser = optparse.OptionParser(
+        description='Время импорта модулей для разных наборов этапов'
+    )
+    parser.add_option(
+        '--repeat',
+        action='store', type=int, dest='repeat', default=10,
+        help='Количество запусков на сценарий (по умолчанию 10)'
+    )
+    options, args = parser.parse_args()
+    return options
+
+
+def measure(code, repeat):
+    """Медиана времени запуска интерпретатора с кодом code, с"""
+    durations = []
+    for i in range(repeat):
+        time_start = time.perf_counter()
+        subprocess.check_call([sys.executable, '-c', code], cwd=ROOT_DIR)
+        durations.append(time.perf_counter() - time_start)
+    return statistics.median(durations)
+
+
+def main():
+    options = read_flag_conf()
+    baseline = measure('pass', options.repeat)
+    results = [(name, measure(code, options.repeat))
+               for name, code in SCENARIOS]
+    full = dict(results)['all'] - baseline
+
+    print('%-12s %10s %10s' % ('сценарий', 'импорт, с', 'от all, %'))
+    for name, duration in results:
+        cost = duration - baseline
+        print('%-12s %10.3f %10.0f' % (name, cost,
+                                       100 * cost / full if full else 0))
+
+
+if __name__ == '__main__':
+    main()
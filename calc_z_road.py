@@ -7,15 +7,21 @@
 
 import sys
 import optparse
+from concurrent.futures import ThreadPoolExecutor
 
-from conf import BadConf, read_conf, show_conf, db_connect, make_logger
+from conf import BadConf, read_conf, show_conf, db_connect, make_logger, \
+    get_pool, set_pool_size, transaction, check_commit_policy, \
+    commit_scope, prepare_cursor, POOL_SIZE
 from common import get_amount
 from helpers import Timer, ask_confirmation, total_exit
+import profiling
+import queries
+from queries import execute, register
 
 # Исключения
 from common import ProcessRoadError
 from calc.helpers import ProcessError
-from validators import InvalidInputError
+from validators import InvalidInputError, has_columns, get_road_infos
 from helpers import fmt_ex
 
 
@@ -51,13 +57,49 @@ def read_flag_conf():
     parser.add_option(
         '--road-codes',
         action='store', type=str, dest='road_codes',
-        help='Код дороги'
+        help='Коды дорог через запятую (без пробелов)'
     )
     parser.add_option(
         '--km-beg',
         action='store', type=str, dest='km_beg',
         help='Км начала дороги'
     )
+    parser.add_option(
+        '--single-pass',
+        action='store_true', dest='single_pass',
+        default=False,
+        help='Пересчитать ось одной транзакцией с минимумом перезаписей'
+    )
+    parser.add_option(
+        '--profile-sql',
+        action='store_true', dest='profile_sql',
+        default=False,
+        help='Собрать статистику по SQL-запросам'
+    )
+    parser.add_option(
+        '--profile-sql-explain',
+        action='store', type=int, dest='profile_sql_explain',
+        default=0,
+        help='Получить EXPLAIN ANALYZE для N самых медленных запросов'
+    )
+    parser.add_option(
+        '--no-prepare',
+        action='store_true', dest='no_prepare',
+        default=False,
+        help='Не использовать подготовленные операторы (PREPARE/EXECUTE)'
+    )
+    parser.add_option(
+        '--commit',
+        action='store', type=str, dest='commit',
+        help='Политика фиксации транзакций: statement (по умолчанию), '
+             'road или run'
+    )
+    parser.add_option(
+        '--jobs',
+        action='store', type=int, dest='jobs',
+        default=1,
+        help='Количество дорог, обрабатываемых параллельно'
+    )
 
     options, args = parser.parse_args()
 
@@ -72,10 +114,15 @@ def make_conf(options):
     conf.setdefault('db_pass', 'postgres')
     conf.setdefault('project', '')
     conf.setdefault('logfile', '')
-    conf.setdefault('road_codes', '')
-    # conf.setdefault('road_codes', [])
-    conf.setdefault('km_beg', '')
+    conf.setdefault('road_codes', [])
+    conf.setdefault('km_beg', 0)
     conf.setdefault('quiet', True)
+    conf.setdefault('jobs', 1)
+    conf.setdefault('single_pass', False)
+    conf.setdefault('commit', 'statement')
+    conf.setdefault('prepared_statements', True)
+    conf.setdefault('profile_sql', False)
+    conf.setdefault('profile_sql_explain', 0)
 
     if options.project:
         conf['db_name'] = 'dorgis_' + options.project
@@ -90,13 +137,193 @@ def make_conf(options):
             raise BadConf('Км начала дороги должен быть вещественным числом.')
     if options.road_codes:
         try:
-            conf['road_codes'] = int(options.road_codes)
+            conf['road_codes'] = [int(rc) for rc in options.road_codes.split(',')]
         except ValueError:
-            raise BadConf('Код дороги должен быть целым числом')
+            raise BadConf('Коды дорог должны быть целыми числами')
+    if options.single_pass:
+        conf['single_pass'] = True
+    if options.profile_sql:
+        conf['profile_sql'] = True
+        conf['profile_sql_explain'] = options.profile_sql_explain
+    if options.no_prepare:
+        conf['prepared_statements'] = False
+    if options.commit:
+        conf['commit'] = check_commit_policy(options.commit)
+    # этапов нет, дорога - самая мелкая единица
+    if conf['commit'] == 'stage':
+        conf['commit'] = 'road'
+    if options.jobs < 1:
+        raise BadConf('Количество параллельных потоков должно быть не меньше 1')
+    conf['jobs'] = options.jobs
 
     return conf
 
 
+# Размер порции панорам при перепривязке
+PANORAMA_CHUNK = 10000
+
+
+# Перепривязка всех панорам дороги одним запросом (нет поля id)
+SQL_PANO_REBIND_ALL = register('pano_rebind_all', '''
+    UPDATE tbl_panoram_road ta
+    SET km_beg = ST_InterpolatePoint_Meters(
+        (
+            SELECT geom
+            FROM tbl_roads tb
+            WHERE road_code = ta.road_code
+            ORDER BY tb.geom <-> ta.geom
+            LIMIT 1
+        ),
+        ta.geom
+    )
+    WHERE road_code = %(road_code)s
+''')
+
+# Количество панорам и начало перебора по id (до первой панорамы)
+SQL_PANO_COUNT = register('pano_count', '''
+    SELECT count(1) AS c, coalesce(min(id), 0) - 1 AS last_id
+    FROM tbl_panoram_road
+    WHERE road_code = %(road_code)s
+''')
+
+# Порция панорам после last_id: ближайший участок оси по индексу.
+# Условие p.id > last_id без вариантов (NULL): общий план подготовленного
+# оператора продолжает перебор по индексу (road_code, id), а не с начала
+SQL_PANO_REBIND_CHUNK = register('pano_rebind_chunk', '''
+    WITH chunk AS (
+        SELECT p.id, p.geom
+        FROM tbl_panoram_road p
+        WHERE p.road_code = %(road_code)s
+            AND p.id > %(last_id)s::bigint
+        ORDER BY p.id
+        LIMIT %(chunk)s::int
+    ), nearest AS (
+        SELECT c.id, ST_InterpolatePoint_Meters(r.geom, c.geom) AS km
+        FROM chunk c
+        CROSS JOIN LATERAL (
+            SELECT tb.geom
+            FROM tbl_roads tb
+            WHERE tb.road_code = %(road_code)s
+            ORDER BY tb.geom <-> c.geom
+            LIMIT 1
+        ) AS r
+    ), upd AS (
+        UPDATE tbl_panoram_road ta
+        SET km_beg = n.km
+        FROM nearest n
+        WHERE ta.id = n.id
+        RETURNING ta.id
+    )
+    SELECT (SELECT max(id) FROM chunk) AS last_id,
+           (SELECT count(1) FROM upd) AS updated
+''')
+
+
+def rebind_panoramas(logger, cursor, road_code, chunk=PANORAMA_CHUNK):
+    """
+    Перепривязать панорамы дороги к новому километражу.
+    Ближайший участок оси ищется по индексу (оператор <-> в LATERAL),
+    панорамы обрабатываются порциями по id с выводом прогресса.
+    """
+
+    logger.info('Перепривязка панорам.')
+
+    # Без поля id порции выделить нельзя - один запрос на всю дорогу
+    if not has_columns(cursor, 'tbl_panoram_road', ('id',), 'public'):
+        execute(cursor, SQL_PANO_REBIND_ALL, {'road_code': road_code})
+        return
+
+    execute(cursor, SQL_PANO_COUNT, {'road_code': road_code})
+    row = cursor.fetchone()
+    total = row['c']
+
+    last_id = row['last_id']
+    done = 0
+    while True:
+        execute(cursor, SQL_PANO_REBIND_CHUNK,
+                {'road_code': road_code, 'last_id': last_id, 'chunk': chunk})
+        row = cursor.fetchone()
+        if row['last_id'] is None:
+            break
+        last_id = row['last_id']
+        done += row['updated']
+        logger.info('Перепривязано панорам: %d из %d' % (done, total))
+
+
+# 3D ось и M-координата одной перезаписью tbl_roads
+SQL_AXIS_Z_M = register('axis_z_m', '''
+    UPDATE tbl_roads t
+    SET geomz = z.geomz, geom = ST_Force3DM(z.geomz)
+    FROM (
+        SELECT ctid AS tid, get_linez_from_line(geom, road_code) AS geomz
+        FROM tbl_roads
+        WHERE road_code = %(road_code)s
+    ) AS z
+    WHERE t.ctid = z.tid
+''')
+
+# Сдвиг начала/конца дороги и M-координаты одной перезаписью
+SQL_SHIFT_FMP_M = register('shift_fmp_m', '''
+    UPDATE tbl_roads
+    SET fmp = fmp + %(fmp)s::float8,
+        tmp = fmp + %(fmp)s::float8 + length_km,
+        geom = ST_AddMeasure_Meters(geom, fmp + %(fmp)s::float8,
+                                    fmp + %(fmp)s::float8 + length_km)
+    WHERE road_code = %(road_code)s
+''')
+
+SQL_AXIS_Z = register('axis_z', '''
+    update tbl_roads set geomz = get_linez_from_line(geom, road_code)
+    where road_code = %(road_code)s
+''')
+
+SQL_AXIS_M = register('axis_m', '''
+    update tbl_roads set geom = ST_Force3DM(geomz)
+    where road_code = %(road_code)s
+''')
+
+SQL_ROAD_MEASURE = register('road_measure', '''
+    select update_road_measure(%(road_code)s)
+''')
+
+SQL_SHIFT_FMP = register('shift_fmp', '''
+    update tbl_roads
+    set fmp = (fmp + %(fmp)s::float8), tmp = (fmp + %(fmp)s::float8 + length_km)
+    where road_code = %(road_code)s
+''')
+
+SQL_ADD_MEASURE = register('add_measure', '''
+    update tbl_roads SET geom = ST_AddMeasure_Meters(geom, fmp, tmp)
+    where road_code = %(road_code)s
+''')
+
+
+def process_z_single_pass(logger, cursor, conf, road_code):
+    """
+    Пересчитать ось одной транзакцией с минимумом перезаписей tbl_roads:
+    geomz и geom пишутся одним UPDATE, fmp/tmp и M-координата - другим.
+    При ошибке все изменения дороги откатываются.
+    """
+
+    with transaction(cursor):
+        logger.info('Расчёт 3D оси и преобразование М-координаты.')
+        execute(cursor, SQL_AXIS_Z_M, {'road_code': road_code})
+
+        # обновляем длину дороги (функция БД, отдельной перезаписью)
+        logger.info('Обновление длины дороги.')
+        execute(cursor, SQL_ROAD_MEASURE, {'road_code': road_code})
+
+        # пересчёт длины оси если дорога начинается не с 0
+        if conf['km_beg'] > 0:
+            logger.info('Изменение начала, конца и М-координаты дороги.')
+            execute(cursor, SQL_SHIFT_FMP_M, {'road_code': road_code,
+                                              'fmp': conf['km_beg']})
+
+            rebind_panoramas(logger, cursor, road_code)
+
+    logger.info('Расчёт Z-значения оси завершён.')
+
+
 def process_z(logger, cursor, conf, road_code):
     """
     Запустить все указанные в conf обработчики по дороге и
@@ -108,104 +335,86 @@ def process_z(logger, cursor, conf, road_code):
     road_len = get_amount(cursor, [road_code])
     logger.info('Длина дороги: %d м' % road_len)
     logger.info('Расчёт Z-значения оси начался.')
+
+    if conf['single_pass']:
+        return process_z_single_pass(logger, cursor, conf, road_code)
+
     logger.info('Расчёт 3D оси.')
     
     # Считаем 3D геометрию пишем в geomz
-    sql_upd_z = '''
-        update tbl_roads set geomz = get_linez_from_line(geom, road_code) where road_code = %(road_code)s
-    '''% {'road_code': road_code}
-    cursor.execute(sql_upd_z)
-    
+    execute(cursor, SQL_AXIS_Z, {'road_code': road_code})
+
     # передаём в geom M-координату
     logger.info('Преобразование М-координаты.')
-    sql_upd_m = '''
-        update tbl_roads set geom = ST_Force3DM(geomz) where road_code = %(road_code)s
-    '''% {'road_code': road_code}
-    cursor.execute(sql_upd_m)
+    execute(cursor, SQL_AXIS_M, {'road_code': road_code})
 
     # обновляем длину дороги
     logger.info('Обновление длины дороги.')
-    sql = '''
-        select update_road_measure(%(road_code)s)
-    '''% {'road_code': road_code}
-    cursor.execute(sql)
+    execute(cursor, SQL_ROAD_MEASURE, {'road_code': road_code})
 
     # пересчёт длины оси если дорога начинается не с 0
     if conf['km_beg'] > 0:
         logger.info('Изменение начала и конца дороги.')
-        sql_upd_fmp = '''
-            update tbl_roads set fmp = (fmp + %(fmp)s), tmp = (fmp+ %(fmp)s + length_km) where road_code = %(road_code)s
-        '''% {'road_code': road_code, 'fmp': conf['km_beg']}
-        cursor.execute(sql_upd_fmp)
-        
+        execute(cursor, SQL_SHIFT_FMP, {'road_code': road_code,
+                                        'fmp': conf['km_beg']})
+
         logger.info('Изменение М-координаты дороги.')
-        sql_upd_m2 = '''
-            update tbl_roads SET geom = ST_AddMeasure_Meters(geom, fmp, tmp) where road_code = %(road_code)s
-        '''% {'road_code': road_code}
-        cursor.execute(sql_upd_m2)
-
-        logger.info('Перепривязка панорам.')
-        sql_upd_pano = '''
-            UPDATE tbl_panoram_road ta
-            SET km_beg = ST_InterpolatePoint_Meters(
-                (
-                    SELECT geom
-                    FROM tbl_roads tb
-                    WHERE road_code = ta.road_code
-                    ORDER BY ST_Distance(tb.geom,ta.geom)
-                    LIMIT 1
-                ),
-                ta.geom
-            )
-            WHERE road_code = %(road_code)s;
-        '''% {'road_code': road_code}
-        cursor.execute(sql_upd_pano)
-
-    # также добавляем/изменяем запись в словаре dict_roads
-    sql = '''
-        SELECT EXISTS (
-            SELECT 1
-            FROM dorgis.dict_roads
-            WHERE road_code = %(road_code)s
-        )
-    ''' % {'road_code': road_code}
-    cursor.execute(sql)
-    res = cursor.fetchone()['exists']
-    
-    if res:
-        sql_dict = '''
-            UPDATE dorgis.dict_roads SET lenght = (
-                SELECT sum(length_km) as length_km
-                FROM tbl_roads
-                WHERE road_code = %(road_code)s
-                group by road_code
-            )
-            WHERE road_code=%(road_code)s
-        ''' % {'road_code': road_code}
-    
-        logger.info('Изменена запись в dict_roads.')
+        execute(cursor, SQL_ADD_MEASURE, {'road_code': road_code})
 
-    else:
-        sql_dict = '''
-            INSERT INTO dorgis.dict_roads(road_code, name, lenght)
-                SELECT road_code, name, sum(length_km) as lenght
-                FROM tbl_roads
-                where road_code = %(road_code)s
-                group by road_code, name
-        ''' % {'road_code': road_code}
+        rebind_panoramas(logger, cursor, road_code)
 
-        logger.info('Добавлена запись в dict_roads.')
+    logger.info('Расчёт Z-значения оси завершён.')
 
-    cursor.execute(sql_dict)
 
-    logger.info('Расчёт Z-значения оси завершён.')
+def update_dict_roads(logger, cursor, road_codes):
+    """
+    Добавить/изменить записи в словаре dict_roads сразу для всех дорог
+    одним запросом
+    """
+
+    sql_dict = '''
+        INSERT INTO dorgis.dict_roads(road_code, name, lenght)
+            SELECT road_code, min(name), sum(length_km) as lenght
+            FROM tbl_roads
+            WHERE road_code = ANY(%(road_codes)s)
+            GROUP BY road_code
+        ON CONFLICT (road_code) DO UPDATE SET lenght = EXCLUDED.lenght
+        RETURNING road_code, (xmax = 0) AS inserted
+    '''
+    cursor.execute(sql_dict, {'road_codes': road_codes})
+
+    for row in cursor.fetchall():
+        if row['inserted']:
+            logger.info('Добавлена запись в dict_roads (дорога %d).' % row['road_code'])
+        else:
+            logger.info('Изменена запись в dict_roads (дорога %d).' % row['road_code'])
+
+
+def get_roads_without_tins(cursor, road_codes):
+    """
+    Дороги из списка, по потокам которых нет поверхностей
+    (по сведениям о дорогах, загруженным одним запросом)
+    """
+
+    return [info.road_code for info in get_road_infos(cursor, road_codes)
+            if not info.has_tins]
+
+
+def run_process_z(logger, cursor, conf, road_code):
+    """Обработать дорогу, вернуть True при успехе"""
+    try:
+        process_z(logger, cursor, conf, road_code)
+    except (ProcessRoadError, ProcessError, InvalidInputError) as e:
+        logger.error(fmt_ex(e))
+        return False
+    return True
+
 
 # Парсинг аргументов командной строки
 options, args = read_flag_conf()
 
 conf = make_conf(options)
-
-road_code = int(conf['road_codes'])   
+queries.configure(conf)
 
 # Логи
 logger = make_logger(conf['logfile'], conf['quiet'])
@@ -213,7 +422,12 @@ logger = make_logger(conf['logfile'], conf['quiet'])
 # Засечь время
 timer = Timer()
 timer.start()
-     
+if conf['profile_sql']:
+    profiling.enable(timer, conf['logfile'])
+
+# Основное соединение + по одному на каждый параллельный поток
+set_pool_size(POOL_SIZE['min'], max(POOL_SIZE['max'], conf['jobs'] + 1))
+
 try:
     cursor = db_connect(conf['db_server'], conf['db_name'],
                         conf['db_user'], conf['db_pass'])
@@ -222,40 +436,68 @@ except BadConf as e:
 
 # Оценка объёма работы (длина всех дорог)
 try:
-    amount = get_amount(cursor, [road_code])
+    amount = get_amount(cursor, conf['road_codes'])
 except ProcessRoadError as e:
     logger.error(fmt_ex(e))
     total_exit(logger, timer, 'Не удалось получить длину дорог: '+fmt_ex(e))
 logger.info('AMOUNT: %d' % amount)
 
 errors_count = 0
- 
-# Проверка существования поверхностей по потокам данной дороги
-sql = '''
-    SELECT EXISTS (
-        SELECT 1
-        FROM tbl_las_tin
-        WHERE fname IN (
-            SELECT fname FROM tbl_fname_road_code WHERE road_code = %d
-        )
-        LIMIT 1
-    )
-''' % road_code
-cursor.execute(sql)
-res = cursor.fetchone()['exists']
-if not res:
+errors = None
+
+# Проверка существования поверхностей по потокам дорог (один запрос)
+no_tins = get_roads_without_tins(cursor, conf['road_codes'])
+for road_code in no_tins:
+    logger.error('Сначала загрузите точки и поверхности по дороге %s' % road_code)
     errors_count += 1
-    errors = 'Сначала загрузите точки и поверхности по дороге %s' % road_code
+road_codes = [rc for rc in conf['road_codes'] if rc not in no_tins]
+
+# Запуск обработчиков
+done = []
+if conf['jobs'] > 1 and len(road_codes) > 1:
+    pool = get_pool(conf['db_server'], conf['db_name'],
+                    conf['db_user'], conf['db_pass'])
+    # у каждого потока своё соединение - фиксация "по запуску" в нём
+    # сводится к фиксации по дороге (иначе транзакцию никто не зафиксирует)
+    policy = 'road' if conf['commit'] == 'run' else conf['commit']
+
+    def work(road_code):
+        with pool.cursor() as road_cursor:
+            prepare_cursor(road_cursor, policy)
+            with commit_scope(road_cursor, policy, 'road'):
+                return run_process_z(logger, road_cursor, conf, road_code)
+
+    with ThreadPoolExecutor(max_workers=conf['jobs']) as executor:
+        results = list(executor.map(work, road_codes))
+    for road_code, ok in zip(road_codes, results):
+        if ok:
+            done.append(road_code)
+        else:
+            errors_count += 1
 else:
-    # Запуск обработчиков
-    try:
-        process_z(logger, cursor, conf, road_code)
-    except (ProcessRoadError, ProcessError, InvalidInputError) as e:
-        logger.error(fmt_ex(e))
-        errors_count += 1
-        errors = 'Завершено с ошибками (%d)' % errors_count
-
-if errors_count == 0:
-    errors = None    
-
-total_exit(logger, timer, errors)
\ No newline at end of file
+    prepare_cursor(cursor, conf['commit'])
+    with commit_scope(cursor, conf['commit'], 'run'):
+        for road_code in road_codes:
+            with commit_scope(cursor, conf['commit'], 'road'):
+                ok = run_process_z(logger, cursor, conf, road_code)
+            if ok:
+                done.append(road_code)
+            else:
+                errors_count += 1
+
+# Словарь dict_roads - одним запросом по всем обработанным дорогам
+if done:
+    with commit_scope(cursor, conf['commit'], conf['commit']):
+        update_dict_roads(logger, cursor, done)
+
+if errors_count and errors_count == len(no_tins):
+    errors = 'Сначала загрузите точки и поверхности по дорогам %s' % \
+        ', '.join(str(rc) for rc in no_tins)
+elif errors_count:
+    errors = 'Завершено с ошибками (%d)' % errors_count
+
+# Планы самых медленных запросов
+if conf['profile_sql'] and conf['profile_sql_explain']:
+    profiling.PROFILER.explain(cursor, conf['profile_sql_explain'])
+
+total_exit(logger, timer, errors)
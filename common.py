@@ -2,18 +2,28 @@
 Чтение входного файла, импорт обычных объектов.
 """
 
-from calc.curves_in_plane import calc_curves_in_plane
-from calc.iri import calc_iri
-from calc.latprofile import calc_latprofile
-from calc.roadways import calc_roadways
-#from calc.rut import calc_rut
-from calc.rut2 import calc_rut
-from calc.transverse_slopes import calc_transverse_slopes
-from calc.width import calc_width
-from calc.defects import calc_def
-from calc.objects import calc_z, import_table
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import importlib
+import inspect
+import logging
+import multiprocessing
+import os
+import threading
+import time
+
 from validators import check_road, check_object, check_table, \
-    check_input_data, check_tins
+    check_input_data, check_tins, get_input_tables, get_road_infos, \
+    InvalidInputError
+from calc.helpers import ProcessError
+from conf import BadConf, TASK_NAMES, db_connect, get_pool, commit_scope, \
+    prepare_cursor, transaction
+import journal
+import profiling
+import progress
+import incremental
+from incremental import FingerprintStore, get_road_inputs, \
+    stage_fingerprint, TIN_ONLY_STAGES
+from helpers import Timer, fmt_ex, load_json, save_json, span, span_path
 
 
 class ProcessRoadError(Exception):
@@ -24,23 +34,59 @@ class ProcessRoadError(Exception):
 def get_amount(cursor, road_codes):
     """Получить общую длину дорог из списка road_codes"""
 
+    amount = sum(info.length or 0
+                 for info in get_road_infos(cursor, road_codes))
+    if not amount:
+        raise ProcessRoadError('Не найдены дороги из списка '
+                               'или у них не заполнено поле length_km')
+
+    return int(amount)
+
+
+def get_road_lengths(cursor, road_codes):
+    """Получить длину каждой дороги из списка road_codes, м"""
+
+    return dict((info.road_code, info.length or 0)
+                for info in get_road_infos(cursor, road_codes))
+
+
+# UTM-зоны, определённые в текущем процессе: db_name -> srid
+_utm_cache = {}
+
+
+def get_roads_fingerprint(cursor):
+    """Отпечаток содержимого tbl_roads (число строк и максимальный xmin)"""
+
     sql = '''
-        SELECT sum(length_km)*1000 AS len
+        SELECT count(1) AS c, max(xmin::text::bigint) AS x
         FROM tbl_roads
-        WHERE road_code IN (%s)
-    ''' % ','.join([str(rc) for rc in road_codes])
+    '''
     cursor.execute(sql)
     row = cursor.fetchone()
 
-    if not row or not row['len']:
-        raise ProcessRoadError('Не найдены дороги из списка '
-                               'или у них не заполнено поле length_km')
+    return [row['c'], row['x']]
 
-    return int(row['len'])
 
+def get_utm(cursor, conf=None):
+    """
+    Определить UTM-зону проекта.
+    Зона кэшируется в процессе и в файле cache_dir/utm.json по имени БД,
+    кэш сбрасывается при изменении tbl_roads.
+    """
+
+    db_name = conf.get('db_name') if conf else None
+    if db_name in _utm_cache:
+        return _utm_cache[db_name]
 
-def get_utm(cursor):
-    """Определить UTM-зону проекта"""
+    cache_file = None
+    if db_name and conf.get('cache_dir'):
+        cache_file = os.path.join(conf['cache_dir'], 'utm.json')
+        fingerprint = get_roads_fingerprint(cursor)
+        cache = load_json(cache_file, {})
+        item = cache.get(db_name)
+        if item and item['fingerprint'] == fingerprint:
+            _utm_cache[db_name] = item['srid']
+            return item['srid']
 
     sql = '''
         SELECT srid
@@ -53,7 +99,15 @@ def get_utm(cursor):
         LIMIT 1
     '''
     cursor.execute(sql)
-    utm = cursor.fetchone()['srid']
+    row = cursor.fetchone()
+    utm = row['srid'] if row else None
+
+    if utm and db_name:
+        _utm_cache[db_name] = utm
+        if cache_file:
+            cache = load_json(cache_file, {})
+            cache[db_name] = {'fingerprint': fingerprint, 'srid': utm}
+            save_json(cache_file, cache)
 
     return utm
 
@@ -61,6 +115,10 @@ def get_utm(cursor):
 def get_tables(cursor):
     """Получить имена всех таблиц для импорта"""
 
+    tables = get_input_tables()
+    if tables is not None:
+        return tables
+
     sql = '''
         SELECT DISTINCT table_name
         FROM editor.tbl_acad_objects
@@ -70,6 +128,429 @@ def get_tables(cursor):
     return [t['table_name'] for t in tables]
 
 
+# Таблицы, которые надо загрузить в первую очередь и в нужном порядке
+SPECIAL_TABLES = (
+    'tbl_roadways_line',
+    'tbl_crossroads_endline',
+    'tbl_crossroads',
+    'tbl_roadsides_forcedline',
+    'tbl_roadsides_stopline',
+    'tbl_roadsides_slopeline',
+    'tbl_constructionsapproach',
+    'tbl_constructionssidewalk',
+    'tbl_tbl_constructions',
+    'tbl_busstationsstopping',
+    'tbl_busstationspavilions',
+    'tbl_busstationslanding',
+    'tbl_transitionalroadway'
+)
+
+
+# Обработчики этапов: ключ TASK_NAMES -> (модуль, функция). Модули расчётов
+# (numpy, scipy, matplotlib, shapely) импортируются при первом обращении,
+# поэтому запуск с частью этапов не платит за импорт остальных
+STAGE_HANDLERS = {
+    'import_objects': ('calc.objects', 'import_table'),
+    'roadways': ('calc.roadways', 'calc_roadways'),
+    'width': ('calc.width', 'calc_width'),
+    'transverse_slopes': ('calc.transverse_slopes', 'calc_transverse_slopes'),
+    'latprofile': ('calc.latprofile', 'calc_latprofile'),
+    'curves_in_plane': ('calc.curves_in_plane', 'calc_curves_in_plane'),
+    'def': ('calc.defects', 'calc_def'),
+    #'rut': ('calc.rut', 'calc_rut'),
+    'rut': ('calc.rut2', 'calc_rut'),
+    'iri': ('calc.iri', 'calc_iri'),
+}
+
+
+def get_handler(name):
+    """Функция-обработчик этапа name (импорт модуля при первом вызове)"""
+    module, func = STAGE_HANDLERS[name]
+    return getattr(importlib.import_module(module), func)
+
+
+def preload_stages(conf=None):
+    """
+    Импортировать модули включённых в conf этапов (всех, если conf не задан)
+    заранее - до создания рабочих процессов, чтобы они получили модули
+    при fork, а не импортировали каждый сам
+    """
+    for stage in STAGES:
+        if conf is None or stage.enabled(conf):
+            get_handler(stage.name)
+
+
+def import_objects(logger, cursor, conf, road_code, utm):
+    """Расчёт Z-значений и импорт объектов дороги"""
+
+    objects = importlib.import_module(STAGE_HANDLERS['import_objects'][0])
+    import_table = objects.import_table
+
+    # Расчёт Z-значений (не будет считаться, если посчитано ранее)
+    objects.calc_z(logger, cursor, road_code)
+
+    # Импорт обочин, кромок и съездов
+    for table in SPECIAL_TABLES:
+        # Импортировать только если есть входные данные на замену
+        if check_input_data(cursor, road_code, table):
+            import_table(logger, cursor, road_code, table)
+
+    # Импорт остальных объектов
+    for table in get_tables(cursor):
+        # Таблицы, которые были загружены выше
+        if table in SPECIAL_TABLES:
+            continue
+
+        # Пройтись по объектам слоя и загрузить каждый.
+        # Импортировать только если есть входные данные на замену.
+        if check_input_data(cursor, road_code, table):
+            import_table(logger, cursor, road_code, table)
+
+
+class Stage(object):
+    """Этап обработки дороги"""
+
+    def __init__(self, name, func, requires=(), explicit=False,
+                 windows=False):
+        # Ключ из TASK_NAMES (и conf)
+        self.name = name
+        # Обработчик: func(logger, cursor, conf, road_code, utm)
+        self.func = func
+        # Этапы, результаты которых нужны этому этапу
+        self.requires = requires
+        # Этап выполняется только при явном указании (не через -a)
+        self.explicit = explicit
+        # Этап можно выполнять по окнам M-координаты (--window), если
+        # функция расчёта принимает window
+        self.windows = windows
+
+    def supports_windows(self):
+        return self.windows and supports_window(get_handler(self.name))
+
+    def enabled(self, conf):
+        if self.explicit:
+            return bool(conf[self.name])
+        return bool(conf['all'] or conf[self.name])
+
+
+# Граф этапов обработки дороги. Порядок списка - порядок последовательного
+# запуска, он же согласован с зависимостями
+STAGES = [
+    Stage('import_objects', import_objects),
+    # Расчёт и запись площадного слоя "Проезжая часть"
+    Stage('roadways',
+          lambda logger, cursor, conf, road_code, utm:
+              get_handler('roadways')(logger, cursor, road_code, utm),
+          requires=('import_objects',)),
+    # Расчёт ширины ПЧ и обочин
+    Stage('width',
+          lambda logger, cursor, conf, road_code, utm, **kw:
+              get_handler('width')(logger, cursor, utm, road_code, **kw),
+          requires=('roadways',), windows=True),
+    # Расчёт поперечных уклонов
+    Stage('transverse_slopes',
+          lambda logger, cursor, conf, road_code, utm, **kw:
+              get_handler('transverse_slopes')(logger, cursor, utm,
+                                               road_code, **kw),
+          requires=('roadways', 'width'), windows=True),
+    # Расчёт продольного профиля
+    Stage('latprofile',
+          lambda logger, cursor, conf, road_code, utm:
+              get_handler('latprofile')(logger, cursor, road_code),
+          requires=('import_objects',)),
+    # Расчёт кривых в плане
+    Stage('curves_in_plane',
+          lambda logger, cursor, conf, road_code, utm:
+              get_handler('curves_in_plane')(logger, cursor, utm, road_code),
+          requires=('import_objects',)),
+    # Расчёт БКАД диагностики (8 таблиц)
+    Stage('def',
+          lambda logger, cursor, conf, road_code, utm:
+              get_handler('def')(cursor, logger, utm, road_code),
+          requires=('width', 'transverse_slopes', 'latprofile',
+                    'curves_in_plane'),
+          explicit=True),
+    # Расчёт колейности (нужны только поверхности)
+    Stage('rut',
+          lambda logger, cursor, conf, road_code, utm, **kw:
+              get_handler('rut')(conf, logger, utm, road_code, **kw),
+          explicit=True, windows=True),
+    # Расчёт ровности покрытия (нужны только поверхности)
+    Stage('iri',
+          lambda logger, cursor, conf, road_code, utm, **kw:
+              get_handler('iri')(cursor, logger, utm, road_code, **kw),
+          explicit=True, windows=True),
+]
+
+
+def get_stages(conf):
+    """Включённые в conf этапы в порядке последовательного запуска"""
+    return [s for s in STAGES if s.enabled(conf)]
+
+
+def supports_window(func):
+    """
+    Функция расчёта поддерживает окна: принимает аргумент window или
+    отмечена атрибутом supports_window
+    """
+    if getattr(func, 'supports_window', False):
+        return True
+    try:
+        return 'window' in inspect.signature(func).parameters
+    except (TypeError, ValueError):
+        return False
+
+
+def plan_windows(cursor, road_code, window, overlap):
+    """
+    Разбить дорогу на окна по M-координате (м, по fmp/tmp из tbl_roads):
+    список (core_from, core_to, ext_from, ext_to). Основные интервалы
+    [core_from, core_to) не пересекаются и покрывают дорогу, расширенные
+    добавляют overlap с каждой стороны для расчёта у границ. Короткий
+    хвост присоединяется к последнему окну.
+    """
+
+    sql = '''
+        SELECT min(fmp)*1000 AS m_from, max(tmp)*1000 AS m_to
+        FROM tbl_roads
+        WHERE road_code = %(road_code)s
+    '''
+    cursor.execute(sql, {'road_code': road_code})
+    row = cursor.fetchone()
+    if not row or row['m_from'] is None or row['m_to'] is None:
+        return []
+
+    m_from, m_to = row['m_from'], row['m_to']
+    windows = []
+    core_from = m_from
+    while core_from < m_to:
+        core_to = core_from + window
+        if m_to - core_to < window / 4:
+            core_to = m_to
+        windows.append((core_from, core_to, max(m_from, core_from - overlap),
+                        min(m_to, core_to + overlap)))
+        core_from = core_to
+    return windows
+
+
+def run_windows(stage, logger, cursor, conf, road_code, utm, windows):
+    """
+    Выполнить этап по окнам. Функция расчёта считает по расширенному
+    интервалу окна и записывает результаты только основного, поэтому
+    результаты окон стыкуются без разрывов и повторов.
+    При conf['window_jobs'] > 1 окна выполняются параллельно, каждое
+    на своём соединении из пула и в своей транзакции.
+    """
+
+    logger.info('Этап "%s": %d окон по %d м' %
+                (TASK_NAMES[stage.name], len(windows), conf['window']))
+    jobs = min(conf.get('window_jobs', 1), len(windows))
+    if jobs <= 1:
+        for i, window in enumerate(windows):
+            with span('window:%d' % i):
+                stage.func(logger, cursor, conf, road_code, utm,
+                           window=window)
+        return
+
+    pool = get_pool(conf['server'], conf['db_name'],
+                    conf['db_user'], conf['db_pass'])
+    policy = conf.get('commit', 'statement')
+    parent = span_path()
+
+    def work(i, window):
+        with pool.cursor() as window_cursor, \
+                span('window:%d' % i, parent):
+            prepare_cursor(window_cursor, policy)
+            with commit_scope(window_cursor, policy, 'stage'):
+                stage.func(logger, window_cursor, conf, road_code, utm,
+                           window=window)
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(work, i, window)
+                   for i, window in enumerate(windows)]
+        for future in futures:
+            future.result()
+
+
+def run_stage(stage, logger, cursor, conf, road_code, utm):
+    """Выполнить этап, сообщив о начале и завершении в поток хода работы"""
+    progress.emit('stage_start', road_code=road_code, stage=stage.name)
+    time_start = time.perf_counter()
+    ok = False
+    try:
+        windows = []
+        if conf.get('window') and stage.supports_windows():
+            windows = plan_windows(cursor, road_code, conf['window'],
+                                   conf['window_overlap'])
+        if len(windows) > 1:
+            run_windows(stage, logger, cursor, conf, road_code, utm, windows)
+        else:
+            stage.func(logger, cursor, conf, road_code, utm)
+        ok = True
+    finally:
+        progress.emit('stage_end', road_code=road_code, stage=stage.name,
+                      ok=ok, duration=time.perf_counter() - time_start)
+
+
+def read_road_inputs(logger, cursor, road_code, stages):
+    """
+    Сведения о входных данных дороги для отпечатков этапов stages или
+    None, если их не удалось получить (ошибка не прерывает обработку)
+    """
+    objects = any(s.name not in TIN_ONLY_STAGES for s in stages)
+    try:
+        # Ошибка запроса не должна прервать транзакцию дороги
+        with transaction(cursor):
+            return get_road_inputs(cursor, road_code, objects)
+    except Exception as e:
+        logger.warning('Не удалось получить входные данные для отпечатков '
+                       'этапов: %s' % fmt_ex(e))
+        return None
+
+
+def run_stages(logger, cursor, conf, road_code, utm):
+    """
+    Выполнить включённые в conf этапы по дороге.
+    При conf['stage_jobs'] > 1 независимые этапы выполняются параллельно,
+    каждый на своём соединении из пула.
+    Этапы, входные данные которых не менялись с последнего успешного
+    запуска, пропускаются (если не указан --force).
+    """
+
+    stages = get_stages(conf)
+    names = set(s.name for s in stages)
+
+    # С --force отпечатки не проверяются, но сохраняются: по ним
+    # последующие запуски узнают о пересчёте этапов-предшественников.
+    # Не удалось прочитать входные данные - этапы не пропускаются
+    store = None
+    if conf.get('cache_dir'):
+        inputs = read_road_inputs(logger, cursor, road_code, stages)
+        if inputs is not None:
+            store = FingerprintStore(conf, road_code)
+    # Этапы, фактически выполненные в этом запуске
+    executed = set()
+    # Интервал дороги - родитель интервалов этапов из других потоков
+    parent = span_path()
+    policy = conf.get('commit', 'statement')
+
+    def skip(stage):
+        """
+        Пропустить этап, если он выполнен в прерванном запуске (--resume)
+        или его входные данные не изменились
+        """
+        # Если пересчитан этап-предшественник, пересчитать и этот
+        if any(r in executed for r in stage.requires):
+            return False
+        if journal.is_done(road_code, stage.name):
+            reason = 'выполнен в прерванном запуске'
+        elif store is not None and not conf.get('force') and \
+                stage.name in store.data and \
+                store.get(stage.name) == stage_fingerprint(
+                    stage.name, inputs, conf, store.stamps(stage.requires)):
+            reason = 'входные данные не изменились'
+        else:
+            return False
+        logger.info('Этап "%s" пропущен: %s' % (TASK_NAMES[stage.name],
+                                                reason))
+        progress.emit('stage_end', road_code=road_code, stage=stage.name,
+                      ok=True, skipped=True, duration=0)
+        return True
+
+    try:
+        if conf.get('stage_jobs', 1) <= 1 or len(stages) <= 1:
+            for stage in stages:
+                if not skip(stage):
+                    with span(stage.name), \
+                            commit_scope(cursor, policy, 'stage'):
+                        run_stage(stage, logger, cursor, conf, road_code,
+                                  utm)
+                    executed.add(stage.name)
+                    journal.record(road_code, stage.name)
+                    journal.flush(policy, 'stage')
+            return
+
+        pool = get_pool(conf['server'], conf['db_name'],
+                        conf['db_user'], conf['db_pass'])
+
+        def work(stage):
+            with pool.cursor() as stage_cursor, span(stage.name, parent):
+                prepare_cursor(stage_cursor, policy)
+                with commit_scope(stage_cursor, policy, 'stage'):
+                    run_stage(stage, logger, stage_cursor, conf, road_code,
+                              utm)
+            journal.record(road_code, stage.name)
+            journal.flush(policy, 'stage')
+
+        # Зависимости только от этапов, которые есть в этом запуске
+        pending = dict((s.name, set(r for r in s.requires if r in names))
+                       for s in stages)
+        done = set()
+        running = {}
+        error = None
+
+        with ThreadPoolExecutor(max_workers=conf['stage_jobs']) as executor:
+            while pending or running:
+                if error is None:
+                    skipped = False
+                    for stage in stages:
+                        if stage.name in pending and \
+                                pending[stage.name] <= done:
+                            del pending[stage.name]
+                            if skip(stage):
+                                done.add(stage.name)
+                                skipped = True
+                            else:
+                                future = executor.submit(work, stage)
+                                running[future] = stage.name
+                    # Пропуск мог сделать доступными следующие этапы
+                    if skipped:
+                        continue
+                if not running:
+                    break
+
+                finished, _ = wait(list(running),
+                                   return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        future.result()
+                    except Exception as e:
+                        # Новые этапы не запускаем, ждём уже запущенные
+                        if error is None:
+                            error = e
+                    else:
+                        done.add(name)
+                        executed.add(name)
+
+        if error is not None:
+            raise error
+
+    finally:
+        # Запомнить отпечатки успешно выполненных этапов по состоянию
+        # данных после обработки - с ним сравнится следующий запуск.
+        # Файл записывается после фиксации транзакции, как и журнал
+        if store is not None and executed:
+            inputs = read_road_inputs(logger, cursor, road_code, stages)
+        if store is not None and executed and inputs is not None:
+            try:
+                # Сначала отметки выполнения: отпечаток этапа включает
+                # отметки предшественников, выполненных в этом же запуске
+                stamp = time.time()
+                for name in executed:
+                    store.set(name, None, stamp)
+                requires = dict((s.name, s.requires) for s in stages)
+                for name in executed:
+                    store.set(name, stage_fingerprint(
+                        name, inputs, conf, store.stamps(requires[name])),
+                        stamp)
+                incremental.defer(store)
+                incremental.flush(policy, 'stage')
+            except Exception as e:
+                logger.warning('Не удалось сохранить отпечатки этапов: %s' %
+                               fmt_ex(e))
+
+
 def process_road(logger, cursor, conf, road_code):
     """
     Запустить все указанные в conf обработчики по дороге и
@@ -78,8 +559,8 @@ def process_road(logger, cursor, conf, road_code):
 
     logger.info('Дорога: %d' % road_code)
 
-    # Определение UTM-зоны
-    utm = get_utm(cursor)
+    # Определение UTM-зоны (--srid или кэш проекта)
+    utm = conf.get('srid') or get_utm(cursor, conf)
     if not utm:
         raise ProcessRoadError('Не удалось определить зону UTM')
 
@@ -93,74 +574,144 @@ def process_road(logger, cursor, conf, road_code):
     if not check_tins(cursor, road_code):
         raise ProcessRoadError('Отсутствуют поверхности')
 
-    # Расчёт Z-значений (не будет считаться, если посчитано ранее)
-    if conf['all'] or conf['import_objects']:
-        calc_z(logger, cursor, road_code)
-
-    # Таблицы, которые надо загрузить в первую очередь и в нужном порядке
-    special_tables = (
-        'tbl_roadways_line',
-        'tbl_crossroads_endline',
-        'tbl_crossroads',
-        'tbl_roadsides_forcedline',
-        'tbl_roadsides_stopline',
-        'tbl_roadsides_slopeline',
-        'tbl_constructionsapproach',
-        'tbl_constructionssidewalk',
-        'tbl_tbl_constructions',
-        'tbl_busstationsstopping',
-        'tbl_busstationspavilions',
-        'tbl_busstationslanding',
-        'tbl_transitionalroadway'
-    )
+    run_stages(logger, cursor, conf, road_code, utm)
 
-    # Импорт обочин, кромок и съездов
-    if conf['all'] or conf['import_objects']:
-        for table in special_tables:
-            # Импортировать только если есть входные данные на замену
-            if check_input_data(cursor, road_code, table):
-                import_table(logger, cursor, road_code, table)
-
-    # Импорт остальных объектов
-    if conf['all'] or conf['import_objects']:
-        for table in get_tables(cursor):
-            # Таблицы, которые были загружены выше
-            if table in special_tables:
-                continue
-
-            # Пройтись по объектам слоя и загрузить каждый.
-            # Импортировать только если есть входные данные на замену.
-            if check_input_data(cursor, road_code, table):
-                import_table(logger, cursor, road_code, table)
-
-    # Расчёт и запись площадного слоя "Проезжая часть"
-    if conf['all'] or conf['roadways']:
-        calc_roadways(logger, cursor, road_code, utm)
-
-    # Расчёт ширины ПЧ и обочин
-    if conf['all'] or conf['width']:
-        calc_width(logger, cursor, utm, road_code)
-
-    # Расчёт поперечных уклонов
-    if conf['all'] or conf['transverse_slopes']:
-        calc_transverse_slopes(logger, cursor, utm, road_code)
 
-    # Расчёт продольного профиля
-    if conf['all'] or conf['latprofile']:
-        calc_latprofile(logger, cursor, road_code)
-
-    # Расчёт кривых в плане
-    if conf['all'] or conf['curves_in_plane']:
-        calc_curves_in_plane(logger, cursor, utm, road_code)
-
-    # Расчёт БКАД диагностики (8 таблиц)
-    if conf['def']:
-        calc_def(cursor, logger, utm, road_code)
+def run_road(logger, cursor, conf, handler, road_code):
+    """
+    Обработать дорогу обработчиком handler в границах фиксации по дороге,
+    вернуть признак успеха. Дорога, завершённая в прерванном запуске,
+    пропускается (--resume).
+    """
 
-    # Расчёт колейности
-    if conf['rut']:
-        calc_rut(conf, logger, utm, road_code)
+    if journal.is_done(road_code):
+        logger.info('Дорога %d пропущена: обработана в прерванном запуске' %
+                    road_code)
+        progress.emit('road_end', road_code=road_code, ok=True, skipped=True)
+        return True
+
+    progress.emit('road_start', road_code=road_code)
+    try:
+        with span('road:%d' % road_code), \
+                commit_scope(cursor, conf['commit'], 'road'):
+            handler(logger, cursor, conf, road_code)
+    except (ProcessRoadError, ProcessError, InvalidInputError) as e:
+        # Завершённые этапы дороги зафиксированы, их отметки сохраняются
+        logger.error('Дорога %d: %s' % (road_code, fmt_ex(e)))
+        ok = False
+    except Exception:
+        # Транзакция не зафиксирована - отметки и отпечатки не записываются
+        journal.discard()
+        incremental.discard()
+        raise
+    else:
+        journal.record(road_code)
+        ok = True
+    # Отметки и отпечатки этапов, зафиксированных вместе с дорогой
+    journal.flush(conf['commit'], 'road')
+    incremental.flush(conf['commit'], 'road')
+    progress.emit('road_end', road_code=road_code, ok=ok)
+    return ok
+
+
+# Соединение рабочего процесса (у каждого процесса своё)
+_worker = {}
+
+
+def _init_worker(queue=None):
+    """Инициализация рабочего процесса"""
+    # Статистика запросов родителя, скопированная при fork, не нужна
+    if profiling.PROFILER:
+        profiling.PROFILER.take()
+    # События хода работы передаются родителю через очередь
+    progress.REPORTER = None
+    progress.QUEUE = queue
+
+
+def _process_road_worker(args):
+    """Обработать одну дорогу в рабочем процессе"""
+
+    handler, conf, road_code = args
+    logger = logging.getLogger()
+
+    if 'cursor' not in _worker:
+        try:
+            _worker['cursor'] = prepare_cursor(
+                db_connect(conf['server'], conf['db_name'],
+                           conf['db_user'], conf['db_pass']),
+                conf['commit'])
+        except BadConf as e:
+            logger.error('Дорога %d: не удалось подключиться к БД: %s' %
+                         (road_code, fmt_ex(e)))
+            return road_code, False, [], {}
+
+    # Интервалы времени, собранные в этом процессе, вернуть родителю
+    spans_start = len(Timer.current.spans) if Timer.current else 0
+    ok = run_road(logger, _worker['cursor'], conf, handler, road_code)
+    spans = Timer.current.spans[spans_start:] if Timer.current else []
+
+    sql_stats = profiling.PROFILER.take() if profiling.PROFILER else {}
+
+    return road_code, ok, spans, sql_stats
+
+
+def run_roads(logger, cursor, conf, handler):
+    """
+    Обработать все дороги из conf['road_codes'] обработчиком handler и
+    вернуть количество дорог, завершившихся с ошибкой.
+    При conf['jobs'] > 1 каждая дорога обрабатывается в отдельном процессе
+    со своим соединением с БД.
+    """
 
-    # Расчёт ровности покрытия
-    if conf['iri']:
-        calc_iri(cursor, logger, utm, road_code)
+    errors_count = 0
+
+    if conf['jobs'] <= 1 or len(conf['road_codes']) <= 1:
+        for road_code in conf['road_codes']:
+            if not run_road(logger, cursor, conf, handler, road_code):
+                errors_count += 1
+        return errors_count
+
+    jobs = min(conf['jobs'], len(conf['road_codes']))
+    logger.info('Параллельная обработка дорог, процессов: %d' % jobs)
+
+    # У каждого процесса своё соединение: фиксация "по запуску" в нём
+    # сводится к фиксации по дороге
+    if conf['commit'] == 'run':
+        conf = dict(conf, commit='road')
+    # Модули расчётов импортируются один раз до fork
+    preload_stages(conf)
+    tasks = [(handler, conf, rc) for rc in conf['road_codes']]
+
+    # События хода работы из рабочих процессов
+    queue = drainer = None
+    if progress.REPORTER is not None:
+        queue = multiprocessing.Queue()
+        drainer = threading.Thread(target=progress.drain, args=(queue,))
+        drainer.daemon = True
+        drainer.start()
+
+    pool = multiprocessing.Pool(jobs, _init_worker, (queue,))
+    try:
+        done = 0
+        for road_code, ok, spans, sql_stats in pool.imap_unordered(
+                _process_road_worker, tasks):
+            done += 1
+            if Timer.current:
+                Timer.current.spans.extend(spans)
+            if profiling.PROFILER:
+                profiling.PROFILER.merge(sql_stats)
+            if not ok:
+                errors_count += 1
+            logger.info('Обработано дорог: %d из %d' %
+                        (done, len(conf['road_codes'])))
+        # Рабочие процессы дописывают очередь событий при завершении
+        pool.close()
+        pool.join()
+    finally:
+        pool.terminate()
+        pool.join()
+        if drainer is not None:
+            queue.put(None)
+            drainer.join()
+
+    return errors_count
@@ -2,17 +2,40 @@
 Функции, отвечающие за настройку работы скрипта.
 """
 
+from contextlib import contextmanager
+import decimal
+import io
+import itertools
 import json
 import logging
 from logging.config import dictConfig
 import optparse
 import os
+import struct
+import threading
+import time
 import psycopg2
+import psycopg2.extensions
 import psycopg2.extras
+import psycopg2.pool
+
+from helpers import add_db_time
 
 
 DIR = os.path.dirname(os.path.abspath(__file__))
-CONF_FILE = 'conf.json'
+# Файл конфигурации (путь можно переопределить переменной окружения
+# DORGIS_CONF, например для бенчмарков)
+CONF_FILE = os.environ.get('DORGIS_CONF', 'conf.json')
+LOG_FILE = 'from_autocad.log'
+# Каталог для локальных кэшей (переопределяется ключом cache_dir в conf.json)
+CACHE_DIR = os.path.join(DIR, 'cache')
+
+# Перекрытие окон по M-координате по умолчанию, м (--window-overlap)
+WINDOW_OVERLAP = 200
+
+# Размеры пулов соединений по умолчанию (переопределяются ключами
+# pool_min и pool_max в conf.json)
+POOL_SIZE = {'min': 1, 'max': 10}
 
 TASK_NAMES = {
     'import_objects': 'Импорт объектов',
@@ -32,20 +55,201 @@ class BadConf(Exception):
     pass
 
 
+class ConnectionPool(object):
+    """
+    Пул соединений с одной БД.
+    Перед выдачей соединение проверяется, мёртвые соединения заменяются.
+    """
+
+    def __init__(self, server, db_name, db_user, db_pass,
+                 minconn=None, maxconn=None):
+        minconn = POOL_SIZE['min'] if minconn is None else minconn
+        maxconn = POOL_SIZE['max'] if maxconn is None else maxconn
+        self.maxconn = maxconn
+        try:
+            self._pool = psycopg2.pool.ThreadedConnectionPool(
+                minconn, maxconn,
+                database=db_name, host=server,
+                user=db_user, password=db_pass
+            )
+        except psycopg2.OperationalError as e:
+            raise BadConf(str(e))
+
+    def _getconn(self):
+        try:
+            return self._pool.getconn()
+        except (psycopg2.OperationalError, psycopg2.pool.PoolError) as e:
+            raise BadConf(str(e))
+
+    @staticmethod
+    def _is_alive(connection):
+        """Проверить, что соединение рабочее"""
+        if connection.closed:
+            return False
+        try:
+            if connection.get_transaction_status() != \
+                    psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                connection.rollback()
+            # До запроса: вне транзакции режим можно переключить
+            connection.autocommit = True
+            cursor = connection.cursor()
+            cursor.execute('SELECT 1')
+            cursor.close()
+        except psycopg2.Error:
+            return False
+        return True
+
+    def getconn(self):
+        """Взять соединение из пула"""
+        connection = self._getconn()
+        if not self._is_alive(connection):
+            self._pool.putconn(connection, close=True)
+            connection = self._getconn()
+            connection.autocommit = True
+        with _pools_lock:
+            _borrowed[id(connection)] = (self, connection)
+        return connection
+
+    def putconn(self, connection):
+        """Вернуть соединение в пул"""
+        with _pools_lock:
+            _borrowed.pop(id(connection), None)
+        close = bool(connection.closed)
+        if not close:
+            # Соединение возвращается без открытой транзакции
+            # и в режиме autocommit, как его выдал getconn
+            try:
+                connection.rollback()
+                connection.autocommit = True
+            except psycopg2.Error:
+                close = True
+        self._pool.putconn(connection, close=close)
+
+    @contextmanager
+    def cursor(self, mode='dict'):
+        """Взять курсор на время блока with"""
+        connection = self.getconn()
+        try:
+            yield get_cursor(connection, mode)
+        finally:
+            self.putconn(connection)
+
+    def closeall(self):
+        self._pool.closeall()
+
+
+# Пулы по параметрам подключения. В ключе есть pid: после fork дочерний
+# процесс не должен пользоваться (и закрывать) соединения родителя
+_pools = {}
+# Выданные из пулов соединения: id(connection) -> (pool, connection)
+_borrowed = {}
+_pools_lock = threading.RLock()
+
+
+def set_pool_size(minconn, maxconn):
+    """Задать размеры создаваемых пулов"""
+    if not 0 <= minconn <= maxconn or maxconn < 1:
+        raise BadConf('Неверные размеры пула соединений: %s-%s' %
+                      (minconn, maxconn))
+    POOL_SIZE['min'] = minconn
+    POOL_SIZE['max'] = maxconn
+
+
+def get_pool(server, db_name, db_user, db_pass):
+    """Получить (создать при необходимости) пул соединений с БД"""
+    key = (os.getpid(), server, db_name, db_user)
+    with _pools_lock:
+        pool = _pools.get(key)
+        # Размер пулов увеличен после создания пула (следующее задание
+        # сервера daemon.py) - пул пересоздаётся, если из него ничего
+        # не выдано
+        if pool is not None and pool.maxconn < POOL_SIZE['max'] and \
+                not any(item[0] is pool for item in _borrowed.values()):
+            pool.closeall()
+            pool = None
+        if pool is None:
+            pool = _pools[key] = ConnectionPool(server, db_name, db_user,
+                                                db_pass)
+        return pool
+
+
+def release_cursor(cursor):
+    """Вернуть соединение курсора в пул"""
+    with _pools_lock:
+        item = _borrowed.get(id(cursor.connection))
+    if item:
+        item[0].putconn(item[1])
+
+
+def release_all():
+    """Вернуть в пулы все выданные соединения текущего процесса"""
+    with _pools_lock:
+        items = list(_borrowed.values())
+    for pool, connection in items:
+        pool.putconn(connection)
+
+
+class TimedCursorMixin(object):
+    """Учёт времени запросов в таймере процесса (helpers.Timer)"""
+
+    def execute(self, query, vars=None):
+        time_start = time.perf_counter()
+        try:
+            return super(TimedCursorMixin, self).execute(query, vars)
+        finally:
+            add_db_time(time.perf_counter() - time_start)
+
+    def executemany(self, query, vars_list):
+        time_start = time.perf_counter()
+        try:
+            return super(TimedCursorMixin, self).executemany(query, vars_list)
+        finally:
+            add_db_time(time.perf_counter() - time_start)
+
+    def copy_expert(self, sql, file, size=8192):
+        time_start = time.perf_counter()
+        try:
+            return super(TimedCursorMixin, self).copy_expert(sql, file, size)
+        finally:
+            add_db_time(time.perf_counter() - time_start)
+
+
+class TimedDictCursor(TimedCursorMixin, psycopg2.extras.RealDictCursor):
+    pass
+
+
+class TimedTupleCursor(TimedCursorMixin, psycopg2.extensions.cursor):
+    pass
+
+
+class TimedNamedTupleCursor(TimedCursorMixin, psycopg2.extras.NamedTupleCursor):
+    pass
+
+
+# Классы курсоров, которые выдаёт get_cursor (profiling подменяет их):
+# dict - строки-словари (для небольших запросов метаданных),
+# tuple - обычные кортежи, slots - именованные кортежи (__slots__, доступ
+# по имени поля без словаря на каждую строку)
+CURSOR_FACTORIES = {
+    'dict': TimedDictCursor,
+    'tuple': TimedTupleCursor,
+    'slots': TimedNamedTupleCursor,
+}
+
+# Строк за одно обращение к серверу при потоковом чтении
+STREAM_FETCH_SIZE = 10000
+_stream_names = itertools.count()
+
+
 def db_connect(server, db_name, db_user, db_pass):
-    try:
-        connection = psycopg2.connect(
-            database=db_name, host=server,
-            user=db_user, password=db_pass
-        )
-        connection.autocommit = True
-    except psycopg2.OperationalError as e:
-        raise BadConf(str(e))
-    cursor = connection.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    """Курсор на соединении из пула (вернуть - release_cursor)"""
+    connection = get_pool(server, db_name, db_user, db_pass).getconn()
+    cursor = get_cursor(connection)
     return cursor
 
 
 def get_db_connect(server, db_name, db_user, db_pass):
+    """Отдельное соединение вне пула, закрывает вызывающий"""
     try:
         connection = psycopg2.connect(
             database=db_name, host=server,
@@ -57,8 +261,374 @@ def get_db_connect(server, db_name, db_user, db_pass):
     return connection
 
 
-def get_cursor(connection):
-    return connection.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+# Политики фиксации транзакций - от самой частой к самой редкой:
+# statement - каждый запрос (autocommit), stage - этап, road - дорога,
+# run - весь запуск. Этапы при политиках road/run выполняются в точках
+# сохранения: ошибка этапа откатывает только его изменения.
+COMMIT_POLICIES = ('statement', 'stage', 'road', 'run')
+
+_savepoints = itertools.count()
+
+
+def check_commit_policy(policy):
+    if policy not in COMMIT_POLICIES:
+        raise BadConf('Неизвестная политика фиксации %s (допустимы: %s)' %
+                      (policy, ', '.join(COMMIT_POLICIES)))
+    return policy
+
+
+def prepare_cursor(cursor, policy):
+    """Настроить соединение курсора под политику фиксации"""
+    cursor.connection.autocommit = policy == 'statement'
+    return cursor
+
+
+def _quiet(cursor, sql):
+    """Выполнить служебный запрос, не маскируя исходную ошибку"""
+    try:
+        cursor.execute(sql)
+    except psycopg2.Error:
+        pass
+
+
+# Контрольные точки открытых границ дороги и запуска по соединениям:
+# id(connection) -> [имя точки сохранения]. Точка переносится после каждой
+# завершённой вложенной границы, ошибка откатывает изменения до неё
+_checkpoints = {}
+
+
+def _run(cursor, statements, quiet):
+    for sql in statements:
+        if quiet:
+            _quiet(cursor, sql)
+        else:
+            cursor.execute(sql)
+
+
+def _advance(cursor, quiet=False):
+    """Перенести контрольную точку внешней границы на текущее состояние"""
+    checkpoints = _checkpoints.get(id(cursor.connection))
+    if checkpoints:
+        _run(cursor, ['RELEASE SAVEPOINT ' + checkpoints[-1],
+                      'SAVEPOINT ' + checkpoints[-1]], quiet)
+
+
+@contextmanager
+def commit_scope(cursor, policy, level):
+    """
+    Граница уровня level ('stage', 'road', 'run') при политике policy:
+    на уровне политики - COMMIT при выходе, на более мелком уровне - точка
+    сохранения. Ошибка этапа откатывает этап. Ошибка дороги или запуска
+    откатывает изменения после последнего завершённого этапа (дороги),
+    завершённые этапы сохраняются.
+    """
+    connection = cursor.connection
+    if connection.autocommit or \
+            COMMIT_POLICIES.index(level) > COMMIT_POLICIES.index(policy):
+        yield
+        return
+
+    if level == policy == 'stage':
+        try:
+            yield
+        except Exception:
+            _quiet_rollback(connection)
+            raise
+        connection.commit()
+        return
+
+    name = 'sp_%d' % next(_savepoints)
+    cursor.execute('SAVEPOINT ' + name)
+    checkpoints = _checkpoints.setdefault(id(connection), [])
+    if level != 'stage':
+        checkpoints.append(name)
+    ok = False
+    try:
+        yield
+        ok = True
+    finally:
+        if level != 'stage':
+            checkpoints.pop()
+        if not checkpoints:
+            _checkpoints.pop(id(connection), None)
+        # ROLLBACK TO выполняется и в прерванной ошибкой транзакции
+        if not ok:
+            _quiet(cursor, 'ROLLBACK TO SAVEPOINT ' + name)
+        if level == policy:
+            if ok:
+                connection.commit()
+            else:
+                # Не удалось зафиксировать и завершённые этапы -
+                # сообщить об этом, а не об исходной ошибке
+                try:
+                    connection.commit()
+                except psycopg2.Error:
+                    _quiet_rollback(connection)
+                    raise
+        else:
+            _run(cursor, ['RELEASE SAVEPOINT ' + name], not ok)
+            _advance(cursor, not ok)
+
+
+def _quiet_rollback(connection):
+    try:
+        connection.rollback()
+    except psycopg2.Error:
+        pass
+
+
+@contextmanager
+def transaction(cursor):
+    """
+    Выполнить блок одной транзакцией (или точкой сохранения, если
+    транзакция уже открыта). При исключении изменения откатываются.
+    """
+    connection = cursor.connection
+    # Соединение уже работает в транзакции (политика фиксации) -
+    # блок выполняется в точке сохранения
+    if not connection.autocommit:
+        name = 'sp_%d' % next(_savepoints)
+        cursor.execute('SAVEPOINT ' + name)
+        try:
+            yield
+        except Exception:
+            _quiet(cursor, 'ROLLBACK TO SAVEPOINT ' + name)
+            raise
+        cursor.execute('RELEASE SAVEPOINT ' + name)
+        return
+
+    cursor.execute('BEGIN')
+    try:
+        yield
+    except Exception:
+        _quiet(cursor, 'ROLLBACK')
+        raise
+    cursor.execute('COMMIT')
+
+
+def get_cursor(connection, mode='dict'):
+    return connection.cursor(cursor_factory=CURSOR_FACTORIES[mode])
+
+
+def stream(connection, sql, params=None, mode='tuple',
+           fetch_size=STREAM_FETCH_SIZE):
+    """
+    Прочитать результат запроса через серверный (именованный) курсор:
+    строки приходят порциями по fetch_size и не накапливаются на клиенте
+    """
+    name = 'stream_%d_%d' % (os.getpid(), next(_stream_names))
+    # В режиме autocommit именованный курсор должен переживать транзакцию
+    cursor = connection.cursor(name, cursor_factory=CURSOR_FACTORIES[mode],
+                               withhold=connection.autocommit)
+    cursor.itersize = fetch_size
+    try:
+        cursor.execute(sql, params)
+        for row in cursor:
+            yield row
+    finally:
+        cursor.close()
+
+
+# Строк в буфере BulkWriter до отправки одной командой COPY
+BULK_BUFFER_ROWS = 50000
+
+_COPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+_COPY_TRAILER = struct.pack('>h', -1)
+_NULL_FIELD = struct.pack('>i', -1)
+_bulk_tables = itertools.count()
+
+
+def _encode_numeric(value):
+    """numeric в двоичном формате: цифры по основанию 10000"""
+    if isinstance(value, float):
+        value = decimal.Decimal(repr(value))
+    else:
+        value = decimal.Decimal(value)
+    sign, digits, exp = value.as_tuple()
+    if not isinstance(exp, int):
+        # NaN
+        return struct.pack('>hhHh', 0, 0, 0xC000, 0)
+    dscale = max(0, -exp)
+    digits = list(digits)
+    # Выравнивание по группам из 4 десятичных цифр
+    pad = exp % 4
+    digits += [0] * pad
+    exp -= pad
+    digits = [0] * (-len(digits) % 4) + digits
+    groups = [int(''.join(map(str, digits[i:i + 4])))
+              for i in range(0, len(digits), 4)]
+    weight = len(groups) - 1 + exp // 4
+    while groups and groups[0] == 0:
+        groups.pop(0)
+        weight -= 1
+    while groups and groups[-1] == 0:
+        groups.pop()
+    if not groups:
+        weight = 0
+    return struct.pack('>hhHh', len(groups), weight,
+                       0x4000 if sign else 0, dscale) + \
+        struct.pack('>%dh' % len(groups), *groups)
+
+
+def _encode_text(value):
+    return str(value).encode('utf-8')
+
+
+def _encode_geometry(value, srid):
+    """
+    Геометрия в EWKB: shapely-геометрия (SRID дописывается в заголовок),
+    готовый WKB/EWKB (bytes) или HEX-строка EWKB
+    """
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return bytes(value)
+    if isinstance(value, str):
+        return bytes.fromhex(value)
+
+    from shapely import wkb
+    data = wkb.dumps(value)
+    if not srid:
+        return data
+    fmt = '<I' if data[0:1] == b'\x01' else '>I'
+    geom_type = struct.unpack(fmt, data[1:5])[0]
+    return data[:1] + struct.pack(fmt, geom_type | 0x20000000) + \
+        struct.pack(fmt, srid) + data[5:]
+
+
+COPY_ENCODERS = {
+    'int2': lambda value, srid: struct.pack('>h', value),
+    'int4': lambda value, srid: struct.pack('>i', value),
+    'int8': lambda value, srid: struct.pack('>q', value),
+    'float4': lambda value, srid: struct.pack('>f', value),
+    'float8': lambda value, srid: struct.pack('>d', value),
+    'bool': lambda value, srid: struct.pack('>?', value),
+    'text': lambda value, srid: _encode_text(value),
+    'varchar': lambda value, srid: _encode_text(value),
+    'bpchar': lambda value, srid: _encode_text(value),
+    'numeric': lambda value, srid: _encode_numeric(value),
+    'bytea': lambda value, srid: bytes(value),
+    'geometry': _encode_geometry,
+}
+
+
+def get_column_types(cursor, table):
+    """Типы столбцов таблицы (имя столбца -> имя типа) из pg_attribute"""
+    meta_cursor = get_cursor(cursor.connection, 'tuple')
+    meta_cursor.execute("""
+        SELECT a.attname, t.typname
+        FROM pg_attribute a
+        JOIN pg_type t ON t.oid = a.atttypid
+        WHERE a.attrelid = %s::regclass
+          AND a.attnum > 0 AND NOT a.attisdropped
+    """, (table,))
+    return dict(meta_cursor.fetchall())
+
+
+class BulkWriter(object):
+    """
+    Буферизованная запись строк в таблицу через
+    COPY ... FROM STDIN (FORMAT binary).
+
+    Если задано replace_where, строки сначала пишутся во временную таблицу,
+    а при закрытии в одной транзакции удаляются строки таблицы по условию
+    replace_where и вставляются новые (полная замена, например, по дороге):
+
+        with BulkWriter(cursor, 'dorgis.tbl_rutdepth', columns, srid=utm,
+                        replace_where='road_code = %s',
+                        replace_params=(road_code,)) as writer:
+            for row in rows:
+                writer.add(row)
+    """
+
+    def __init__(self, cursor, table, columns, srid=None,
+                 buffer_rows=BULK_BUFFER_ROWS, replace_where=None,
+                 replace_params=None):
+        self.cursor = cursor
+        self.table = table
+        self.columns = list(columns)
+        self.srid = srid
+        self.buffer_rows = buffer_rows
+        self.replace_where = replace_where
+        self.replace_params = replace_params
+        self.rows = 0
+        self.buffer = []
+
+        types = get_column_types(cursor, table)
+        self.encoders = []
+        for column in self.columns:
+            if column not in types:
+                raise BadConf('Нет столбца %s в таблице %s' % (column, table))
+            if types[column] not in COPY_ENCODERS:
+                raise BadConf('Тип %s столбца %s.%s не поддерживается '
+                              'для записи через COPY' %
+                              (types[column], table, column))
+            self.encoders.append(COPY_ENCODERS[types[column]])
+        self.field_count = struct.pack('>h', len(self.columns))
+
+        self.target = table
+        if replace_where is not None:
+            self.target = 'bulk_%d_%d' % (os.getpid(), next(_bulk_tables))
+            cursor.execute('CREATE TEMP TABLE %s AS SELECT %s FROM %s '
+                           'WITH NO DATA' %
+                           (self.target, ', '.join(self.columns), table))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+    def add(self, row):
+        """Добавить строку (значения в порядке columns, None - NULL)"""
+        parts = [self.field_count]
+        for encoder, value in zip(self.encoders, row):
+            if value is None:
+                parts.append(_NULL_FIELD)
+                continue
+            data = encoder(value, self.srid)
+            parts.append(struct.pack('>i', len(data)))
+            parts.append(data)
+        self.buffer.append(b''.join(parts))
+        if len(self.buffer) >= self.buffer_rows:
+            self.flush()
+
+    def add_many(self, rows):
+        for row in rows:
+            self.add(row)
+
+    def flush(self):
+        """Отправить накопленные строки одной командой COPY"""
+        if not self.buffer:
+            return
+        data = io.BytesIO(b''.join([_COPY_HEADER] + self.buffer +
+                                   [_COPY_TRAILER]))
+        self.cursor.copy_expert('COPY %s (%s) FROM STDIN (FORMAT binary)' %
+                                (self.target, ', '.join(self.columns)), data)
+        self.rows += len(self.buffer)
+        self.buffer = []
+
+    def close(self):
+        """Дописать буфер; в режиме замены - перенести строки в таблицу"""
+        self.flush()
+        if self.replace_where is None:
+            return self.rows
+        columns = ', '.join(self.columns)
+        with transaction(self.cursor):
+            self.cursor.execute('DELETE FROM %s WHERE %s' %
+                                (self.table, self.replace_where),
+                                self.replace_params)
+            self.cursor.execute('INSERT INTO %s (%s) SELECT %s FROM %s' %
+                                (self.table, columns, columns, self.target))
+        self.cursor.execute('DROP TABLE %s' % self.target)
+        return self.rows
+
+    def discard(self):
+        """Отбросить буфер и временную таблицу (при ошибке)"""
+        self.buffer = []
+        if self.replace_where is not None:
+            _quiet(self.cursor, 'DROP TABLE IF EXISTS %s' % self.target)
 
 
 def read_flag_conf():
@@ -100,6 +670,80 @@ def read_flag_conf():
         action='store', type=str, dest='new_calc',
         help='Признак нового пересчета колейности'
     )
+    parser.add_option(
+        '--stage-jobs',
+        action='store', type=int, dest='stage_jobs',
+        default=1,
+        help='Количество этапов обработки дороги, выполняемых параллельно'
+    )
+    parser.add_option(
+        '--jobs',
+        action='store', type=int, dest='jobs',
+        default=1,
+        help='Количество дорог, обрабатываемых параллельно'
+    )
+    parser.add_option(
+        '--window',
+        action='store', type=int, dest='window',
+        default=0,
+        help='Обрабатывать длинные дороги окнами по M-координате '
+             'указанной длины, м (только для этапов, поддерживающих окна)'
+    )
+    parser.add_option(
+        '--window-overlap',
+        action='store', type=int, dest='window_overlap',
+        default=WINDOW_OVERLAP,
+        help='Перекрытие соседних окон, м (по умолчанию %d)' % WINDOW_OVERLAP
+    )
+    parser.add_option(
+        '--window-jobs',
+        action='store', type=int, dest='window_jobs',
+        default=1,
+        help='Количество окон дороги, обрабатываемых параллельно'
+    )
+    parser.add_option(
+        '--profile-sql',
+        action='store_true', dest='profile_sql',
+        default=False,
+        help='Собрать статистику по SQL-запросам'
+    )
+    parser.add_option(
+        '--profile-sql-explain',
+        action='store', type=int, dest='profile_sql_explain',
+        default=0,
+        help='Получить EXPLAIN ANALYZE для N самых медленных запросов'
+    )
+    parser.add_option(
+        '--no-prepare',
+        action='store_true', dest='no_prepare',
+        default=False,
+        help='Не использовать подготовленные операторы (PREPARE/EXECUTE)'
+    )
+    parser.add_option(
+        '--commit',
+        action='store', type=str, dest='commit',
+        help='Политика фиксации транзакций: statement (по умолчанию), '
+             'stage, road или run'
+    )
+    parser.add_option(
+        '--resume',
+        action='store_true', dest='resume',
+        default=False,
+        help='Продолжить прерванный запуск: пропустить дороги и этапы, '
+             'завершённые в прошлых запусках с теми же параметрами'
+    )
+    parser.add_option(
+        '--progress',
+        action='store', type=str, dest='progress',
+        help='Поток событий о ходе работы (JSON): file:ПУТЬ, fd:N '
+             'или unix:ПУТЬ'
+    )
+    parser.add_option(
+        '--force',
+        action='store_true', dest='force',
+        default=False,
+        help='Пересчитать все этапы, даже если входные данные не менялись'
+    )
     # Параметры запуска модулей
     parser.add_option(
         '-a',
@@ -190,7 +834,7 @@ def make_logger(logfile=None, quiet=False):
                 'formatter': 'default'
             },
             'file': {
-                'filename': 'from_autocad.log',
+                'filename': LOG_FILE,
                 'class': 'logging.FileHandler',
                 'formatter': 'default'
             }
@@ -215,6 +859,11 @@ def make_logger(logfile=None, quiet=False):
     return logger
 
 
+def get_metrics_file(logfile=None):
+    """Файл метрик рядом с лог-файлом"""
+    return os.path.splitext(logfile or LOG_FILE)[0] + '.metrics.json'
+
+
 def read_conf():
     """Считать всю конфигурацию в один словарь"""
 
@@ -236,10 +885,30 @@ def read_conf():
     # Составить словарь из options
     attrs = ('logfile', 'quiet', 'all', 'import_objects', 'roadways',
              'width', 'curves_in_plane', 'transverse_slopes', 'latprofile',
-             'rut', 'iri', 'acad', 'def')
+             'rut', 'iri', 'acad', 'def', 'force', 'profile_sql',
+             'profile_sql_explain', 'progress', 'resume')
     for attr in attrs:
         conf[attr] = getattr(options, attr)
 
+    if options.jobs < 1:
+        raise BadConf('Количество параллельных процессов должно быть '
+                      'не меньше 1')
+    conf['jobs'] = options.jobs
+
+    if options.stage_jobs < 1:
+        raise BadConf('Количество параллельных этапов должно быть '
+                      'не меньше 1')
+    conf['stage_jobs'] = options.stage_jobs
+
+    if options.window < 0 or options.window_overlap < 0:
+        raise BadConf('Длина и перекрытие окон не могут быть отрицательными')
+    if options.window_jobs < 1:
+        raise BadConf('Количество параллельных окон должно быть '
+                      'не меньше 1')
+    conf['window'] = options.window
+    conf['window_overlap'] = options.window_overlap
+    conf['window_jobs'] = options.window_jobs
+
     if options.project:
         conf['db_name'] = 'dorgis_' + options.project
      
@@ -247,6 +916,34 @@ def read_conf():
     if options.new_calc:
         conf['new_calc'] = options.new_calc
 
+    if options.commit:
+        conf['commit'] = options.commit
+    conf['commit'] = check_commit_policy(conf.get('commit', 'statement'))
+    # Этапы одной транзакции должны видеть изменения друг друга,
+    # поэтому при фиксации по дороге/запуску они идут на одном соединении
+    if conf['commit'] in ('road', 'run'):
+        conf['stage_jobs'] = 1
+        conf['window_jobs'] = 1
+
+    # Основное соединение + на каждый параллельный этап его собственное
+    # соединение и по одному на каждое его параллельное окно
+    set_pool_size(conf.get('pool_min', POOL_SIZE['min']),
+                  max(conf.get('pool_max', POOL_SIZE['max']),
+                      1 + conf['stage_jobs'] * (1 + conf['window_jobs'])))
+
+    conf.setdefault('cache_dir', CACHE_DIR)
+
+    # Подготовленные операторы для частых запросов (модуль queries)
+    if options.no_prepare:
+        conf['prepared_statements'] = False
+
+    # для сервиса acad обязателен, иначе отключает определение UTM-зоны
+    if options.srid:
+        try:
+            conf['srid'] = int(options.srid)
+        except ValueError:
+            raise BadConf('SRID должен быть целым числом')
+
     # нужен исключительно для сервиса acad
     if options.acad:
         conf['srid'] = int(options.srid)
@@ -281,8 +978,11 @@ def show_conf(conf):
 
     template = ('\nСервер: %s\n'
                 'БД: %s\n'
-                'SRID: вычисляется динамически')
-    print(template % (conf['server'], conf['db_name']))
+                'SRID: %s\n'
+                'Параллельных процессов: %d')
+    print(template % (conf['server'], conf['db_name'],
+                      conf.get('srid') or 'вычисляется динамически',
+                      conf['jobs']))
     print('ЗАДАЧИ:')
     # Задача выполняется, если указана явно или через параметр --all
     for name in ('import_objects', 'roadways', 'width', 'def',
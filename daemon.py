@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+"""
+Сервер для запуска скриптов модуля в заранее прогретых процессах.
+
+Рабочие процессы создаются заранее (prefork): библиотеки расчётов уже
+импортированы, пулы соединений с БД сохраняются между заданиями.
+Задание - одна строка JSON через Unix-сокет или TCP-порт (localhost):
+
+    {"script": "run.py", "args": ["--quiet", "-r", "12"]}
+
+Ответ - одна строка JSON с кодом возврата скрипта и его выводом:
+
+    {"status": 0, "output": "...", "duration": 1.2}
+
+Лог задания пишется в файл, заданный аргументами скрипта, как при обычном
+запуске. Подтверждение запуска не запрашивается: run.py всегда получает
+--quiet.
+
+Запуск сервера:  daemon.py serve --socket /tmp/dorgis.sock --workers 4
+Задание:         daemon.py call --socket /tmp/dorgis.sock run.py --quiet -r 12
+"""
+
+import io
+import json
+import optparse
+import os
+import runpy
+import signal
+import socket
+import sys
+import time
+import traceback
+
+import conf
+from helpers import fmt_ex
+
+
+# Скрипты, которые можно запускать через сервер
+SCRIPTS = ('run.py', 'calc_z_road.py', 'update_km.py')
+
+# Скрипты, которые без --quiet запрашивают подтверждение из stdin
+QUIET_SCRIPTS = ('run.py',)
+
+# Заданий на рабочий процесс до его перезапуска (0 - без ограничения)
+MAX_JOBS = 100
+
+
+def read_flag_conf():
+    """Считать параметры командной строки"""
+
+    parser = optparse.OptionParser(
+        usage='%prog serve|call [параметры] [СКРИПТ АРГУМЕНТЫ...]',
+        description='Сервер прогретых процессов для скриптов модуля'
+    )
+    parser.disable_interspersed_args()
+    parser.add_option('--socket', dest='socket',
+                      help='Путь к Unix-сокету')
+    parser.add_option('--port', dest='port', type='int',
+                      help='TCP-порт на 127.0.0.1 (вместо --socket)')
+    parser.add_option('--workers', dest='workers', type='int', default=2,
+                      help='Количество рабочих процессов (по умолчанию 2)')
+    parser.add_option('--max-jobs', dest='max_jobs', type='int',
+                      default=MAX_JOBS,
+                      help='Заданий на процесс до его перезапуска '
+                           '(по умолчанию %d, 0 - без ограничения)' % MAX_JOBS)
+
+    options, args = parser.parse_args()
+    if not args or args[0] not in ('serve', 'call'):
+        parser.error('Укажите команду serve или call')
+    if bool(options.socket) == bool(options.port):
+        parser.error('Укажите --socket или --port')
+    if args[0] == 'call' and len(args) < 2:
+        parser.error('Укажите скрипт для запуска')
+    if options.workers < 1:
+        parser.error('Количество рабочих процессов должно быть больше 0')
+    return options, args
+
+
+def get_address(options):
+    if options.socket:
+        return socket.AF_UNIX, options.socket
+    return socket.AF_INET, ('127.0.0.1', options.port)
+
+
+def listen(options):
+    family, address = get_address(options)
+    if family == socket.AF_UNIX and os.path.exists(address):
+        os.unlink(address)
+    server = socket.socket(family, socket.SOCK_STREAM)
+    if family == socket.AF_INET:
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(address)
+    server.listen(64)
+    return server
+
+
+def warm_up():
+    """Импортировать модули расчётов до создания рабочих процессов"""
+    import common
+    import common_json
+    import validators
+    common.preload_stages()
+    return common, common_json, validators
+
+
+def reset_state(defaults):
+    """Сбросить состояние процесса после задания"""
+    import common
+    import incremental
+    import journal
+    import profiling
+    import progress
+    import validators
+
+    progress.close()
+    journal.close()
+    incremental.discard()
+    conf.release_all()
+    validators.reset_input_index()
+    validators.reset_schema_cache()
+    validators.reset_road_info()
+    common._utm_cache.clear()
+    profiling.PROFILER = None
+    conf.CURSOR_FACTORIES.clear()
+    conf.CURSOR_FACTORIES.update(defaults['cursors'])
+    conf.POOL_SIZE.update(defaults['pool_size'])
+
+
+def run_job(job):
+    """Выполнить скрипт в текущем процессе, вернуть код возврата и вывод"""
+    script = job.get('script')
+    if script not in SCRIPTS:
+        return 1, 'Неизвестный скрипт: %s\n' % script
+
+    args = [str(arg) for arg in job.get('args', [])]
+    # Ответить на вопрос некому - подтверждение не запрашивается
+    if script in QUIET_SCRIPTS and '--quiet' not in args:
+        args.insert(0, '--quiet')
+
+    output = io.StringIO()
+    saved = sys.argv, sys.stdin, sys.stdout, sys.stderr
+    sys.argv = [script] + args
+    sys.stdin = io.StringIO()
+    sys.stdout = sys.stderr = output
+    try:
+        runpy.run_path(os.path.join(conf.DIR, script), run_name='__main__')
+        status = 0
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            status = e.code or 0
+        else:
+            print(e.code, file=output)
+            status = 1
+    except Exception:
+        traceback.print_exc(file=output)
+        status = 1
+    finally:
+        sys.argv, sys.stdin, sys.stdout, sys.stderr = saved
+    return status, output.getvalue()
+
+
+def handle(client, defaults):
+    """Принять задание из соединения, выполнить и отправить ответ"""
+    stream = client.makefile('rwb')
+    try:
+        line = stream.readline()
+        if not line:
+            return
+        time_start = time.perf_counter()
+        try:
+            job = json.loads(line.decode('utf-8'))
+        except ValueError as e:
+            status, output = 1, 'Неверное задание: %s\n' % fmt_ex(e)
+        else:
+            status, output = run_job(job)
+        reset_state(defaults)
+        response = {'status': status, 'output': output,
+                    'duration': time.perf_counter() - time_start}
+        stream.write((json.dumps(response, ensure_ascii=False) + '\n')
+                     .encode('utf-8'))
+        stream.flush()
+    finally:
+        stream.close()
+        client.close()
+
+
+def worker(server, max_jobs, defaults):
+    """Цикл рабочего процесса: задания по одному до max_jobs"""
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    jobs = 0
+    while not max_jobs or jobs < max_jobs:
+        client, _ = server.accept()
+        handle(client, defaults)
+        jobs += 1
+
+
+def spawn(server, max_jobs, defaults):
+    pid = os.fork()
+    if pid == 0:
+        code = 0
+        try:
+            worker(server, max_jobs, defaults)
+        except BaseException:
+            traceback.print_exc()
+            code = 1
+        finally:
+            os._exit(code)
+    return pid
+
+
+def serve(options):
+    """Создать рабочие процессы и перезапускать завершившиеся"""
+    warm_up()
+    defaults = {'cursors': dict(conf.CURSOR_FACTORIES),
+                'pool_size': dict(conf.POOL_SIZE)}
+    server = listen(options)
+    children = set()
+
+    def stop(signum, frame):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        if options.socket and os.path.exists(options.socket):
+            os.unlink(options.socket)
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for i in range(options.workers):
+        children.add(spawn(server, options.max_jobs, defaults))
+    print('Сервер запущен: %s, процессов: %d' %
+          (options.socket or options.port, options.workers))
+    while True:
+        pid, _ = os.wait()
+        children.discard(pid)
+        children.add(spawn(server, options.max_jobs, defaults))
+
+
+def call(options, script, args):
+    """Отправить задание серверу, вывести результат, вернуть код возврата"""
+    family, address = get_address(options)
+    client = socket.socket(family, socket.SOCK_STREAM)
+    client.connect(address)
+    stream = client.makefile('rwb')
+    try:
+        job = {'script': script, 'args': args}
+        stream.write((json.dumps(job, ensure_ascii=False) + '\n')
+                     .encode('utf-8'))
+        stream.flush()
+        line = stream.readline()
+    finally:
+        stream.close()
+        client.close()
+    if not line:
+        print('Сервер закрыл соединение без ответа', file=sys.stderr)
+        return 1
+    response = json.loads(line.decode('utf-8'))
+    sys.stdout.write(response['output'])
+    return response['status']
+
+
+if __name__ == '__main__':
+    options, args = read_flag_conf()
+    if args[0] == 'serve':
+        serve(options)
+    else:
+        sys.exit(call(options, args[1], args[2:]))
@@ -1,24 +1,147 @@
+from contextlib import contextmanager
+import json
+import os
 import sys
+import threading
+import time
 from datetime import datetime
 
 
 class Timer(object):
-    """Засекатель времени выполнения"""
+    """
+    Засекатель времени выполнения.
+    Кроме общей длительности собирает вложенные интервалы
+    (запуск -> дорога -> этап) с временем запросов к БД.
+    """
+
+    # Запущенный таймер процесса: в него курсоры пишут время запросов
+    current = None
 
     def start(self):
         self.time_start = datetime.now()
+        # Закрытые интервалы: {'path', 'duration', 'db'}
+        self.spans = []
+        # Файл для метрик в JSON (не пишется, если не задан)
+        self.metrics_file = None
+        # Дополнительные отчёты при завершении: func(logger)
+        self.on_exit = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        Timer.current = self
 
     def end(self):
         time_end = datetime.now()
         duration = time_end.timestamp() - self.time_start.timestamp()
         return duration
 
+    def _state(self):
+        """Стек интервалов и счётчик времени БД текущего потока"""
+        state = self._local
+        if not hasattr(state, 'stack'):
+            state.stack = []
+            state.db = 0.0
+        return state
+
+    def path(self):
+        """Путь текущего интервала потока"""
+        return '/'.join(self._state().stack)
+
+    @contextmanager
+    def span(self, name, parent=None):
+        """
+        Засечь интервал name. parent - путь родителя из другого потока
+        (для этапов, выполняемых параллельно).
+        """
+        state = self._state()
+        stack = state.stack
+        saved = list(stack)
+        if parent is not None:
+            stack[:] = parent.split('/') if parent else []
+        stack.append(name)
+        path = '/'.join(stack)
+        time_start = time.perf_counter()
+        db_start = state.db
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - time_start
+            stack[:] = saved
+            with self._lock:
+                self.spans.append({'path': path, 'duration': duration,
+                                   'db': state.db - db_start})
+
+    def add_db_time(self, seconds):
+        """Учесть время запроса к БД в текущем потоке"""
+        self._state().db += seconds
+
+    def report(self):
+        """
+        Сводка по интервалам: время, время БД и количество по каждому
+        этапу (последний элемент пути), по убыванию времени
+        """
+        stats = {}
+        for span in self.spans:
+            name = span['path'].rsplit('/', 1)[-1]
+            if name.startswith('road:'):
+                name = 'road'
+            item = stats.setdefault(name, {'name': name, 'count': 0,
+                                           'duration': 0.0, 'db': 0.0})
+            item['count'] += 1
+            item['duration'] += span['duration']
+            item['db'] += span['db']
+        return sorted(stats.values(), key=lambda i: i['duration'],
+                      reverse=True)
+
+
+def span(name, parent=None):
+    """Интервал в запущенном таймере процесса (если он есть)"""
+    if Timer.current is None:
+        return _null_span()
+    return Timer.current.span(name, parent)
+
+
+def span_path():
+    """Путь текущего интервала (None, если таймер не запущен)"""
+    if Timer.current is None:
+        return None
+    return Timer.current.path()
+
+
+def add_db_time(seconds):
+    if Timer.current is not None:
+        Timer.current.add_db_time(seconds)
+
+
+@contextmanager
+def _null_span():
+    yield
+
 
 def fmt_ex(e):
     """Форматирование ошибок для логов"""
     return str(e).replace('\n', '; ')
 
 
+def load_json(path, default=None):
+    """Прочитать JSON-файл, при отсутствии или ошибке вернуть default"""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+def save_json(path, data):
+    """Атомарно записать JSON-файл (через временный файл)"""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, ensure_ascii=False, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
 def ask_confirmation(question):
     """Спросить подтверждение"""
     print(question, end=' ')
@@ -27,6 +150,26 @@ def ask_confirmation(question):
     return answer == 'y'
 
 
+def write_metrics(logger, timer, duration, status):
+    """Вывести сводку по этапам и записать метрики в JSON"""
+
+    report = timer.report() if getattr(timer, 'spans', None) else []
+    if report:
+        logger.info('ЭТАПЫ (всего, с / БД, с / Python, с / количество):')
+        for item in report:
+            logger.info('  %-20s %10.1f %10.1f %10.1f %6d' % (
+                item['name'], item['duration'], item['db'],
+                item['duration'] - item['db'], item['count']))
+
+    if getattr(timer, 'metrics_file', None):
+        save_json(timer.metrics_file, {
+            'duration': duration,
+            'status': status,
+            'stages': report,
+            'spans': timer.spans,
+        })
+
+
 def total_exit(logger, timer, err=None):
     """Полностью завершить выполнения скрипта и вывести результат"""
 
@@ -40,6 +183,9 @@ def total_exit(logger, timer, err=None):
         code = 0
 
     logger.info('DURATION: %d' % duration)
+    write_metrics(logger, timer, duration, status)
+    for report in getattr(timer, 'on_exit', []):
+        report(logger)
     logger.info('STATUS: '+status)
     if err:
         logger.info('MESSAGE: '+err)
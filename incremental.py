@@ -0,0 +1,162 @@
+"""
+Инкрементальный пересчёт: пропуск этапов обработки дороги, входные данные
+которых не менялись с последнего успешного запуска.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+
+from conf import COMMIT_POLICIES
+from helpers import fmt_ex, load_json, save_json
+
+
+# Этапы, которым нужны только поверхности (объекты editor не влияют)
+TIN_ONLY_STAGES = ('rut', 'iri')
+
+# Отпечатки, ожидающие фиксации транзакции
+_pending = []
+_pending_lock = threading.Lock()
+
+
+def get_road_inputs(cursor, road_code, objects=True):
+    """
+    Собрать сведения о входных данных дороги для отпечатка.
+    objects=False - без объектов editor (нужны только этапам, кроме
+    TIN_ONLY_STAGES); без схемы editor объектов нет.
+    """
+
+    inputs = {}
+
+    # Ось дороги
+    sql = '''
+        SELECT count(1) AS c, max(xmin::text::bigint) AS x
+        FROM tbl_roads
+        WHERE road_code = %(road_code)s
+    '''
+    cursor.execute(sql, {'road_code': road_code})
+    row = cursor.fetchone()
+    inputs['road'] = [row['c'], row['x']]
+
+    # Объекты для импорта по таблицам
+    inputs['objects'] = []
+    if objects:
+        cursor.execute(
+            "SELECT to_regclass('editor.tbl_acad_objects') AS reg")
+        objects = bool(cursor.fetchone()['reg'])
+    if objects:
+        sql = '''
+            SELECT table_name, count(1) AS c, max(xmin::text::bigint) AS x
+            FROM editor.tbl_acad_objects
+            WHERE road_code = %(road_code)s
+            GROUP BY table_name
+            ORDER BY table_name
+        '''
+        cursor.execute(sql, {'road_code': str(road_code)})
+        inputs['objects'] = [[row['table_name'], row['c'], row['x']]
+                             for row in cursor.fetchall()]
+
+    # Поверхности по потокам дороги
+    sql = '''
+        SELECT f.fname, count(t.fname) AS c,
+               max(t.xmin::text::bigint) AS x
+        FROM tbl_fname_road_code f
+        LEFT JOIN tbl_las_tin t ON t.fname = f.fname
+        WHERE f.road_code = %(road_code)s
+        GROUP BY f.fname
+        ORDER BY f.fname
+    '''
+    cursor.execute(sql, {'road_code': road_code})
+    inputs['tins'] = [[row['fname'], row['c'], row['x']]
+                      for row in cursor.fetchall()]
+
+    return inputs
+
+
+def stage_fingerprint(stage_name, inputs, conf, requires=None):
+    """
+    Отпечаток входных данных этапа.
+    requires - отметки последнего выполнения этапов-предшественников:
+    после их пересчёта отпечаток меняется, и этап выполняется снова.
+    """
+
+    data = {
+        'stage': stage_name,
+        'srid': conf.get('srid'),
+        'road': inputs['road'],
+        'tins': inputs['tins'],
+        'requires': requires or {},
+    }
+    if stage_name in TIN_ONLY_STAGES:
+        data['new_calc'] = conf.get('new_calc')
+    else:
+        data['objects'] = inputs['objects']
+
+    raw = json.dumps(data, sort_keys=True, default=str)
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+class FingerprintStore(object):
+    """
+    Отпечатки успешно выполненных этапов дороги и отметки времени их
+    выполнения. Хранятся в cache_dir/fingerprints/<db_name>/<road_code>.json -
+    у каждой дороги свой файл, поэтому параллельные процессы не мешают
+    друг другу.
+    """
+
+    def __init__(self, conf, road_code):
+        self.path = os.path.join(conf['cache_dir'], 'fingerprints',
+                                 conf['db_name'], '%d.json' % road_code)
+        # Этап -> {'fingerprint': ..., 'stamp': ...} (записи старого
+        # формата не совпадут ни с одним отпечатком)
+        self.data = dict((name, item) for name, item
+                         in load_json(self.path, {}).items()
+                         if isinstance(item, dict))
+
+    def get(self, stage_name):
+        return self.data.get(stage_name, {}).get('fingerprint')
+
+    def stamp(self, stage_name):
+        """Время последнего выполнения этапа"""
+        return self.data.get(stage_name, {}).get('stamp')
+
+    def stamps(self, stage_names):
+        return dict((name, self.stamp(name)) for name in stage_names)
+
+    def set(self, stage_name, fingerprint, stamp):
+        self.data[stage_name] = {'fingerprint': fingerprint, 'stamp': stamp}
+
+    def save(self):
+        save_json(self.path, self.data)
+
+
+def defer(store):
+    """Сохранить отпечатки store после фиксации транзакции"""
+    with _pending_lock:
+        _pending.append(store)
+
+
+def flush(policy, level):
+    """
+    Сохранить отложенные отпечатки на границе уровня level ('stage',
+    'road', 'run'), если на ней фиксируется транзакция при политике policy
+    """
+    if COMMIT_POLICIES.index(policy) > COMMIT_POLICIES.index(level):
+        return
+    with _pending_lock:
+        pending = _pending[:]
+        del _pending[:]
+    for store in pending:
+        try:
+            store.save()
+        except (OSError, ValueError) as e:
+            logging.getLogger().warning(
+                'Не удалось сохранить отпечатки этапов: %s' % fmt_ex(e))
+
+
+def discard():
+    """Забыть отложенные отпечатки (транзакция откачена)"""
+    with _pending_lock:
+        del _pending[:]
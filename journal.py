@@ -0,0 +1,191 @@
+"""
+Журнал выполненной работы: пары (дорога, этап), завершённые в запусках
+с теми же параметрами и тем же набором этапов. С --resume завершённые
+дороги и этапы пропускаются, поэтому прерванный запуск продолжается
+с места остановки.
+
+Журнал хранится в SQLite (cache_dir/journal.sqlite); у каждого процесса
+своё соединение, запись из нескольких процессов и потоков безопасна.
+Отметки о выполнении записываются в журнал в момент фиксации транзакции
+на уровне политики (--commit), чтобы не отметить работу, которая может
+быть откачена.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from conf import COMMIT_POLICIES, TASK_NAMES
+
+
+# Журнал текущего запуска
+JOURNAL = None
+
+# Этап, отмечающий завершение всей дороги
+ROAD = ''
+
+# Параметры, от которых зависят результаты этапов
+PARAM_KEYS = ('server', 'db_name', 'srid', 'new_calc', 'acad')
+
+# Ключи включённых этапов: отметка дороги означает выполнение именно
+# этого набора этапов
+STAGE_KEYS = ('all',) + tuple(sorted(TASK_NAMES))
+
+
+def get_journal_file(conf):
+    return os.path.join(conf['cache_dir'], 'journal.sqlite')
+
+
+def get_params(conf):
+    params = dict((key, conf.get(key)) for key in PARAM_KEYS)
+    params['stages'] = [key for key in STAGE_KEYS if conf.get(key)]
+    return params
+
+
+class Journal(object):
+    """Журнал выполненных (дорога, этап) для параметров conf"""
+
+    def __init__(self, path, conf):
+        self.path = path
+        self.params = json.dumps(get_params(conf), sort_keys=True)
+        self.key = hashlib.sha1(self.params.encode('utf-8')).hexdigest()
+        self.resume = False
+        # Завершённые в прошлых запусках пары (road_code, stage)
+        self.completed = set()
+        # Отметки, ожидающие фиксации транзакции
+        self.pending = []
+        self.lock = threading.Lock()
+        self.db = None
+        self.pid = None
+
+    def connect(self):
+        # Соединение, унаследованное при fork, не используется
+        if self.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.db = sqlite3.connect(self.path, timeout=60,
+                                      isolation_level=None,
+                                      check_same_thread=False)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('''
+                CREATE TABLE IF NOT EXISTS runs (
+                    key TEXT PRIMARY KEY,
+                    params TEXT,
+                    started REAL
+                )
+            ''')
+            self.db.execute('''
+                CREATE TABLE IF NOT EXISTS done (
+                    key TEXT,
+                    road_code INTEGER,
+                    stage TEXT,
+                    finished REAL,
+                    PRIMARY KEY (key, road_code, stage)
+                )
+            ''')
+            self.pid = os.getpid()
+        return self.db
+
+    def start(self, road_codes, resume):
+        """
+        Начать запуск: при resume загрузить выполненное ранее,
+        иначе очистить журнал по дорогам запуска
+        """
+        self.resume = resume
+        with self.lock:
+            db = self.connect()
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                db.execute('INSERT OR REPLACE INTO runs VALUES (?, ?, ?)',
+                           (self.key, self.params, time.time()))
+                if not resume:
+                    db.executemany(
+                        'DELETE FROM done WHERE key = ? AND road_code = ?',
+                        [(self.key, rc) for rc in road_codes])
+                db.execute('COMMIT')
+            except sqlite3.Error:
+                db.execute('ROLLBACK')
+                raise
+            if resume:
+                rows = db.execute(
+                    'SELECT road_code, stage FROM done WHERE key = ?',
+                    (self.key,))
+                self.completed = set((rc, stage) for rc, stage in rows)
+
+    def is_done(self, road_code, stage=ROAD):
+        return self.resume and (road_code, stage) in self.completed
+
+    def record(self, road_code, stage=ROAD):
+        with self.lock:
+            self.pending.append((self.key, road_code, stage, time.time()))
+
+    def flush(self):
+        """Записать отметки (после фиксации транзакции)"""
+        with self.lock:
+            pending, self.pending = self.pending, []
+            if not pending:
+                return
+            db = self.connect()
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                db.executemany('INSERT OR REPLACE INTO done '
+                               'VALUES (?, ?, ?, ?)', pending)
+                db.execute('COMMIT')
+            except sqlite3.Error:
+                db.execute('ROLLBACK')
+                raise
+
+    def discard(self):
+        """Забыть отметки (транзакция откачена)"""
+        with self.lock:
+            self.pending = []
+
+    def close(self):
+        if self.db is not None and self.pid == os.getpid():
+            self.db.close()
+        self.db = None
+        self.pid = None
+
+
+def enable(conf):
+    """Открыть журнал запуска (с --resume - продолжить прерванный)"""
+    global JOURNAL
+    JOURNAL = Journal(get_journal_file(conf), conf)
+    JOURNAL.start(conf['road_codes'], conf['resume'])
+    return JOURNAL
+
+
+def close():
+    global JOURNAL
+    if JOURNAL is not None:
+        JOURNAL.close()
+        JOURNAL = None
+
+
+def is_done(road_code, stage=ROAD):
+    """Дорога (или этап дороги) завершена в прерванном запуске"""
+    return JOURNAL is not None and JOURNAL.is_done(road_code, stage)
+
+
+def record(road_code, stage=ROAD):
+    """Отметить дорогу (или этап) выполненной"""
+    if JOURNAL is not None:
+        JOURNAL.record(road_code, stage)
+
+
+def flush(policy, level):
+    """
+    Записать отметки на границе уровня level ('stage', 'road', 'run'),
+    если на ней фиксируется транзакция при политике policy
+    """
+    if JOURNAL is not None and \
+            COMMIT_POLICIES.index(policy) <= COMMIT_POLICIES.index(level):
+        JOURNAL.flush()
+
+
+def discard():
+    """Забыть отметки, ожидающие фиксации (транзакция откачена)"""
+    if JOURNAL is not None:
+        JOURNAL.discard()
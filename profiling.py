@@ -0,0 +1,233 @@
+"""
+Профилирование SQL-запросов (ключ --profile-sql).
+"""
+
+import os
+import re
+import sys
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+
+from conf import CURSOR_FACTORIES, TimedCursorMixin, get_cursor
+from helpers import save_json
+import queries
+
+
+# Профилировщик процесса (None, если профилирование выключено)
+PROFILER = None
+
+# Модули, кадры которых пропускаются при определении места вызова
+_SKIP_FILES = (os.path.abspath(__file__),
+               os.path.abspath(sys.modules['conf'].__file__),
+               os.path.abspath(queries.__file__))
+
+
+def normalize_sql(query):
+    """Привести текст запроса к общему виду (без значений параметров)"""
+    if isinstance(query, bytes):
+        query = query.decode('utf-8', 'replace')
+    query = re.sub(r"'(?:[^']|'')*'", '?', query)
+    query = re.sub(r'\b\d+(?:\.\d+)?\b', '?', query)
+    query = re.sub(r'\(\s*\?(?:\s*,\s*\?)+\s*\)', '(?, ...)', query)
+    query = re.sub(r'ARRAY\[\s*\?(?:\s*,\s*\?)*\s*\]', 'ARRAY[...]', query)
+    return ' '.join(query.split())
+
+
+def get_caller():
+    """Место вызова: первый кадр вне conf.py, queries.py и profiling.py"""
+    frame = sys._getframe(2)
+    while frame is not None:
+        filename = os.path.abspath(frame.f_code.co_filename)
+        if filename not in _SKIP_FILES and 'psycopg2' not in filename:
+            return '%s:%d %s' % (os.path.basename(filename), frame.f_lineno,
+                                 frame.f_code.co_name)
+        frame = frame.f_back
+    return '?'
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+class SqlProfiler(object):
+    """Статистика запросов по нормализованному тексту"""
+
+    def __init__(self):
+        self.stats = {}
+        self._lock = threading.Lock()
+
+    def record(self, query, duration, rowcount, caller):
+        key = normalize_sql(query)
+        with self._lock:
+            item = self.stats.get(key)
+            if item is None:
+                item = self.stats[key] = {
+                    'sql': key, 'count': 0, 'total': 0.0, 'times': [],
+                    'rows': 0, 'callers': {}, 'slowest': None,
+                    'slowest_time': 0.0
+                }
+            item['count'] += 1
+            item['total'] += duration
+            item['times'].append(duration)
+            if rowcount and rowcount > 0:
+                item['rows'] += rowcount
+            item['callers'][caller] = item['callers'].get(caller, 0) + 1
+            if duration >= item['slowest_time']:
+                item['slowest_time'] = duration
+                if isinstance(query, bytes):
+                    query = query.decode('utf-8', 'replace')
+                item['slowest'] = query
+
+    def take(self):
+        """Забрать накопленную статистику (для передачи из процесса)"""
+        with self._lock:
+            stats, self.stats = self.stats, {}
+        return stats
+
+    def merge(self, stats):
+        """Добавить статистику другого процесса"""
+        with self._lock:
+            for key, other in stats.items():
+                item = self.stats.get(key)
+                if item is None:
+                    self.stats[key] = other
+                    continue
+                item['count'] += other['count']
+                item['total'] += other['total']
+                item['times'].extend(other['times'])
+                item['rows'] += other['rows']
+                for caller, count in other['callers'].items():
+                    item['callers'][caller] = \
+                        item['callers'].get(caller, 0) + count
+                if other['slowest_time'] >= item['slowest_time']:
+                    item['slowest_time'] = other['slowest_time']
+                    item['slowest'] = other['slowest']
+
+    def report(self):
+        """Запросы по убыванию суммарного времени"""
+        result = []
+        for item in self.stats.values():
+            result.append({
+                'sql': item['sql'],
+                'count': item['count'],
+                'total': item['total'],
+                'p95': percentile(item['times'], 95),
+                'rows': item['rows'],
+                'callers': item['callers'],
+                'slowest_time': item['slowest_time'],
+                'explain': item.get('explain'),
+            })
+        return sorted(result, key=lambda i: i['total'], reverse=True)
+
+    def explain(self, cursor, top):
+        """
+        Получить EXPLAIN (ANALYZE, BUFFERS) для самого медленного вызова
+        top самых медленных запросов. Запрос выполняется повторно внутри
+        транзакции, которая затем откатывается.
+        """
+        items = sorted(self.stats.values(), key=lambda i: i['slowest_time'],
+                       reverse=True)[:top]
+        # Обычный курсор: эти запросы не должны попадать в статистику
+        plain = cursor.connection.cursor()
+        for item in items:
+            try:
+                plain.execute('BEGIN')
+                plain.execute('EXPLAIN (ANALYZE, BUFFERS) ' + item['slowest'])
+                item['explain'] = '\n'.join(row[0] for row in plain.fetchall())
+            except psycopg2.Error as e:
+                item['explain'] = 'EXPLAIN недоступен: %s' % str(e).strip()
+            finally:
+                plain.execute('ROLLBACK')
+        plain.close()
+
+    def write(self, logger, path, top=20):
+        """Вывести самые затратные запросы в лог и записать отчёт в JSON"""
+        report = self.report()
+        logger.info('SQL (всего, с / p95, мс / вызовов / строк):')
+        for item in report[:top]:
+            logger.info('  %10.2f %10.1f %8d %10d  %s' % (
+                item['total'], item['p95'] * 1000, item['count'],
+                item['rows'], item['sql'][:120]))
+        save_json(path, report)
+
+
+class ProfilingCursorMixin(TimedCursorMixin):
+    """Запись каждого запроса в профилировщик процесса"""
+
+    def execute(self, query, vars=None):
+        time_start = time.perf_counter()
+        try:
+            return super(ProfilingCursorMixin, self).execute(query, vars)
+        finally:
+            if PROFILER is not None:
+                # Подготовленный оператор - исходный запрос с параметрами,
+                # иначе в статистике и EXPLAIN окажется EXECUTE
+                source = queries.executing()
+                PROFILER.record(self.mogrify(*source) if source
+                                else self.query or query,
+                                time.perf_counter() - time_start,
+                                self.rowcount, get_caller())
+
+    def executemany(self, query, vars_list):
+        time_start = time.perf_counter()
+        try:
+            return super(ProfilingCursorMixin, self).executemany(query,
+                                                                 vars_list)
+        finally:
+            if PROFILER is not None:
+                PROFILER.record(query, time.perf_counter() - time_start,
+                                self.rowcount, get_caller())
+
+    def copy_expert(self, sql, file, size=8192):
+        time_start = time.perf_counter()
+        try:
+            return super(ProfilingCursorMixin, self).copy_expert(sql, file,
+                                                                 size)
+        finally:
+            if PROFILER is not None:
+                PROFILER.record(sql, time.perf_counter() - time_start,
+                                self.rowcount, get_caller())
+
+
+class ProfilingDictCursor(ProfilingCursorMixin,
+                          psycopg2.extras.RealDictCursor):
+    pass
+
+
+class ProfilingTupleCursor(ProfilingCursorMixin, psycopg2.extensions.cursor):
+    pass
+
+
+class ProfilingNamedTupleCursor(ProfilingCursorMixin,
+                                psycopg2.extras.NamedTupleCursor):
+    pass
+
+
+def get_sql_report_file(logfile):
+    """Файл отчёта по запросам рядом с лог-файлом"""
+    from conf import get_metrics_file
+    return get_metrics_file(logfile).replace('.metrics.json', '.sql.json')
+
+
+def enable(timer, logfile):
+    """
+    Включить профилирование запросов: все курсоры из conf.get_cursor
+    будут записывать статистику, отчёт пишется при total_exit
+    """
+    global PROFILER
+    PROFILER = SqlProfiler()
+    CURSOR_FACTORIES['dict'] = ProfilingDictCursor
+    CURSOR_FACTORIES['tuple'] = ProfilingTupleCursor
+    CURSOR_FACTORIES['slots'] = ProfilingNamedTupleCursor
+
+    path = get_sql_report_file(logfile)
+    timer.on_exit.append(lambda logger: PROFILER.write(logger, path))
+    return PROFILER
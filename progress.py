@@ -0,0 +1,256 @@
+"""
+Поток событий о ходе обработки (--progress): строки JSON с пройденными
+метрами, скоростью (м/с) и оценкой оставшегося времени.
+
+Цель вывода:
+    file:ПУТЬ  - дописывать в файл
+    fd:N       - писать в открытый дескриптор (например, fd:3)
+    unix:ПУТЬ  - отправлять в Unix-сокет (потоковый)
+
+События: run_start, road_start, stage_start, stage_end, road_end,
+heartbeat (раз в HEARTBEAT секунд, с текущими этапами), run_end.
+Доля работы по дороге считается по длине дороги и средней стоимости
+этапов (секунд на метр) из прошлых запусков, которая хранится в
+cache_dir/stage_costs.json.
+"""
+
+from collections import deque
+import json
+import os
+import socket
+import threading
+import time
+
+from helpers import load_json, save_json
+
+
+# Отчёт о ходе работы (в родительском процессе)
+REPORTER = None
+# Очередь событий рабочего процесса (события передаются родителю)
+QUEUE = None
+
+# Окно для скользящей скорости, с
+RATE_WINDOW = 60
+# Период событий heartbeat, с
+HEARTBEAT = 10
+# Доля нового замера в средней стоимости этапа
+COST_WEIGHT = 0.3
+
+
+def open_target(target):
+    """Открыть цель вывода file:/fd:/unix: как текстовый поток"""
+    kind, _, value = target.partition(':')
+    if kind == 'file':
+        return open(value, 'a', encoding='utf-8')
+    if kind == 'fd':
+        return os.fdopen(int(value), 'w', encoding='utf-8', closefd=False)
+    if kind == 'unix':
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(value)
+        return client.makefile('w', encoding='utf-8')
+    raise ValueError('Неизвестная цель вывода хода работы: %s '
+                     '(допустимы file:, fd:, unix:)' % target)
+
+
+def get_costs_file(conf):
+    return os.path.join(conf['cache_dir'], 'stage_costs.json')
+
+
+class Reporter(object):
+    """Подсчёт пройденных метров, скорости и ETA по событиям"""
+
+    def __init__(self, stream, conf, lengths, stages):
+        self.stream = stream
+        self.conf = conf
+        # Длина дорог, м
+        self.lengths = lengths
+        self.stages = stages
+        self.jobs = max(conf.get('jobs', 1), 1)
+        self.costs = load_json(get_costs_file(conf), {})
+        # Вес этапа - стоимость метра (без истории этапы равноценны)
+        known = [c for c in self.costs.values() if c > 0]
+        default = sum(known) / len(known) if known else 1.0
+        self.weights = dict((s, self.costs.get(s) or default) for s in stages)
+        self.road_weight = sum(self.weights.values()) or 1.0
+
+        self.total = sum(lengths.values())
+        self.done = 0.0
+        # Пройдено метров по дорогам в работе
+        self.road_done = {}
+        self.roads_done = 0
+        self.errors = 0
+        # Время начала текущих этапов: (road_code, stage) -> t
+        self.running = {}
+        self.time_start = time.time()
+        self.history = deque([(self.time_start, 0.0)])
+        self.lock = threading.Lock()
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.beat)
+        self.thread.daemon = True
+
+    def write(self, data):
+        try:
+            self.stream.write(json.dumps(data, ensure_ascii=False) + '\n')
+            self.stream.flush()
+        except (OSError, ValueError):
+            pass
+
+    def rate(self, now):
+        """Скользящая скорость, м/с"""
+        while len(self.history) > 1 and \
+                now - self.history[0][0] > RATE_WINDOW:
+            self.history.popleft()
+        if len(self.history) < 2:
+            return None
+        t0, m0 = self.history[0]
+        if now <= t0:
+            return None
+        return (self.done - m0) / (now - t0)
+
+    def eta(self, rate):
+        """Оценка оставшегося времени, с"""
+        left = self.total - self.done
+        if rate:
+            return left / rate
+        # До первых замеров - по стоимости этапов из прошлых запусков
+        if self.costs:
+            return left * self.road_weight / self.jobs
+        return None
+
+    def state(self, now):
+        rate = self.rate(now)
+        eta = self.eta(rate)
+        return {
+            'metres_done': int(self.done),
+            'metres_total': int(self.total),
+            'roads_done': self.roads_done,
+            'roads_total': len(self.lengths),
+            'errors': self.errors,
+            'rate': round(rate, 1) if rate is not None else None,
+            'eta': int(eta) if eta is not None else None,
+        }
+
+    def handle(self, event):
+        with self.lock:
+            self._handle(event)
+
+    def _handle(self, event):
+        now = event.get('time', time.time())
+        name = event['event']
+        road_code = event.get('road_code')
+        road_len = self.lengths.get(road_code, 0)
+        key = (road_code, event.get('stage'))
+
+        if name == 'stage_start':
+            self.running[key] = now
+        elif name == 'stage_end':
+            self.running.pop(key, None)
+            metres = road_len * \
+                self.weights.get(event['stage'], 0) / self.road_weight
+            self.road_done[road_code] = \
+                self.road_done.get(road_code, 0) + metres
+            self.done += metres
+            event['metres'] = int(metres)
+            if event.get('ok') and not event.get('skipped') and road_len:
+                self.learn(event['stage'], event['duration'] / road_len)
+        elif name == 'road_end':
+            self.roads_done += 1
+            # Дорога пройдена целиком (в том числе этапы, не дошедшие
+            # до выполнения из-за ошибки)
+            self.done += road_len - self.road_done.pop(road_code, 0)
+            if not event.get('ok'):
+                self.errors += 1
+                # Невыполненные этапы дороги больше не ожидаются
+                for stage in self.stages:
+                    self.running.pop((road_code, stage), None)
+            event['metres'] = road_len
+        self.history.append((now, self.done))
+
+        data = dict(event, elapsed=round(now - self.time_start, 1))
+        data.update(self.state(now))
+        self.write(data)
+
+    def learn(self, stage, cost):
+        """Обновить среднюю стоимость метра этапа"""
+        old = self.costs.get(stage)
+        self.costs[stage] = cost if not old else \
+            old * (1 - COST_WEIGHT) + cost * COST_WEIGHT
+
+    def beat(self):
+        """Периодическое событие: показывает, что обработка идёт"""
+        while not self.stop.wait(HEARTBEAT):
+            with self.lock:
+                now = time.time()
+                running = []
+                for (road_code, stage), started in sorted(
+                        self.running.items(), key=lambda item: item[1]):
+                    expected = self.costs.get(stage)
+                    running.append({
+                        'road_code': road_code,
+                        'stage': stage,
+                        'elapsed': round(now - started, 1),
+                        'expected': round(
+                            expected * self.lengths.get(road_code, 0), 1)
+                            if expected else None,
+                    })
+                data = {'event': 'heartbeat', 'time': now,
+                        'elapsed': round(now - self.time_start, 1),
+                        'running': running}
+                data.update(self.state(now))
+                self.write(data)
+
+    def start(self):
+        self.write(dict({'event': 'run_start', 'time': self.time_start,
+                         'stages': self.stages}, **self.state(time.time())))
+        self.thread.start()
+
+    def finish(self):
+        self.stop.set()
+        self.thread.join()
+        with self.lock:
+            now = time.time()
+            data = {'event': 'run_end', 'time': now,
+                    'elapsed': round(now - self.time_start, 1)}
+            data.update(self.state(now))
+            self.write(data)
+        save_json(get_costs_file(self.conf), self.costs)
+        self.stream.close()
+
+
+def emit(event, **data):
+    """Отправить событие (из рабочего процесса - через очередь родителю)"""
+    if REPORTER is None and QUEUE is None:
+        return
+    data['event'] = event
+    data['time'] = time.time()
+    if QUEUE is not None:
+        QUEUE.put(data)
+    else:
+        REPORTER.handle(data)
+
+
+def enable(timer, conf, lengths, stages):
+    """
+    Включить поток событий в conf['progress'].
+    lengths - длины дорог в метрах, stages - имена включённых этапов.
+    Итоговое событие и стоимости этапов записываются при total_exit.
+    """
+    global REPORTER
+    REPORTER = Reporter(open_target(conf['progress']), conf, lengths, stages)
+    REPORTER.start()
+    timer.on_exit.append(lambda logger: close())
+    return REPORTER
+
+
+def close():
+    global REPORTER
+    if REPORTER is not None:
+        REPORTER.finish()
+        REPORTER = None
+
+
+def drain(queue):
+    """Передавать события рабочих процессов в отчёт (до None)"""
+    for event in iter(queue.get, None):
+        if REPORTER is not None:
+            REPORTER.handle(event)
@@ -0,0 +1,111 @@
+"""
+Реестр именованных запросов.
+
+Частые короткие запросы (проверки входных данных, перепривязка км,
+пересчёт оси) регистрируются по имени и выполняются как подготовленные
+операторы: PREPARE - один раз на соединение, далее EXECUTE, план
+переиспользуется между дорогами и таблицами. Значения передаются
+параметрами, а не подстановкой в текст SQL.
+
+Параметры в тексте запроса - %(имя)s, имена таблиц и фрагменты SQL -
+{имя} (подставляются при выполнении, для каждого сочетания готовится
+отдельный оператор). С --no-prepare (для run.py также
+"prepared_statements": false в conf.json) запросы выполняются обычным
+execute с теми же параметрами.
+"""
+
+import hashlib
+import re
+import threading
+
+
+# Имя запроса -> текст SQL
+QUERIES = {}
+
+# Выполнять запросы как подготовленные операторы
+PREPARED = True
+
+# Подготовленные операторы по соединениям: (id, pid сервера) -> имена
+_prepared = {}
+# Текст SQL -> (текст для PREPARE, порядок параметров)
+_converted = {}
+
+_PARAM_RE = re.compile(r'%\((\w+)\)s|%%')
+
+# Запрос, выполняемый сейчас через EXECUTE в этом потоке: (sql, params)
+_executing = threading.local()
+
+
+def register(name, sql):
+    """Зарегистрировать запрос, вернуть его имя"""
+    if name in QUERIES and QUERIES[name] != sql:
+        raise ValueError('Запрос %s уже зарегистрирован' % name)
+    QUERIES[name] = sql
+    return name
+
+
+def configure(conf):
+    global PREPARED
+    PREPARED = bool(conf.get('prepared_statements', True))
+
+
+def convert(sql):
+    """Заменить %(имя)s на $N, вернуть текст и порядок параметров"""
+    if sql not in _converted:
+        order = []
+
+        def replace(match):
+            if match.group(1) is None:
+                return '%'
+            if match.group(1) not in order:
+                order.append(match.group(1))
+            return '$%d' % (order.index(match.group(1)) + 1)
+
+        _converted[sql] = (_PARAM_RE.sub(replace, sql), order)
+    return _converted[sql]
+
+
+def statement_name(name, sql):
+    """Имя оператора: имя запроса и хэш текста (с подставленными таблицами)"""
+    digest = hashlib.sha1(sql.encode('utf-8')).hexdigest()
+    return 'q_%s_%s' % (name, digest[:10])
+
+
+def executing():
+    """Исходный текст и параметры запроса, выполняемого через EXECUTE"""
+    return getattr(_executing, 'source', None)
+
+
+def execute(cursor, name, params=None, **parts):
+    """Выполнить запрос name с параметрами params, вернуть курсор"""
+    sql = QUERIES[name]
+    if parts:
+        sql = sql.format(**parts)
+    params = params or {}
+
+    if not PREPARED:
+        cursor.execute(sql, params)
+        return cursor
+
+    connection = cursor.connection
+    key = (id(connection), connection.get_backend_pid())
+    statement = statement_name(name, sql)
+    text, order = convert(sql)
+    prepared = _prepared.setdefault(key, set())
+    if statement not in prepared:
+        cursor.execute('PREPARE %s AS %s' % (statement, text))
+        prepared.add(statement)
+
+    # Профилировщик записывает исходный запрос, а не EXECUTE
+    _executing.source = (sql, params)
+    try:
+        if order:
+            cursor.execute('EXECUTE %s(%s)' % (
+                statement, ', '.join(['%s'] * len(order))),
+                [params[param] for param in order])
+        else:
+            cursor.execute('EXECUTE ' + statement)
+    finally:
+        _executing.source = None
+    return cursor
+
@@ -3,17 +3,25 @@
 Точка входа модуля.
 """
 
+import sqlite3
 import sys
 
-from conf import BadConf, read_conf, show_conf, db_connect, make_logger
-from common import process_road, get_amount
-from common_json import acad_process_road, get_amount
+from conf import BadConf, read_conf, show_conf, db_connect, make_logger, \
+    release_cursor, get_metrics_file, prepare_cursor, commit_scope
+from common import process_road, get_amount, get_utm, run_roads, \
+    get_road_lengths, get_stages
 from helpers import Timer, ask_confirmation, total_exit
+import incremental
+import journal
+import profiling
+import progress
+import queries
 
 # Исключения
 from common import ProcessRoadError
 from calc.helpers import ProcessError
-from validators import InvalidInputError
+from validators import InvalidInputError, load_input_index, \
+    load_schema_cache, load_road_info
 from helpers import fmt_ex
 
 
@@ -23,6 +31,7 @@ try:
 except BadConf as e:
     print(str(e), file=sys.stderr)
     sys.exit(1)
+queries.configure(conf)
 
 # Логи
 logger = make_logger(conf['logfile'], conf['quiet'])
@@ -30,6 +39,9 @@ logger = make_logger(conf['logfile'], conf['quiet'])
 # Засечь время
 timer = Timer()
 timer.start()
+timer.metrics_file = get_metrics_file(conf['logfile'])
+if conf['profile_sql']:
+    profiling.enable(timer, conf['logfile'])
 
 # Проверка настроек
 if not conf['quiet']:
@@ -58,6 +70,7 @@ if conf['acad']:
         conf['server'] = res['server']
     else:
         total_exit(logger, timer, 'Не заведены данные по проекту: '+conf['project'])            
+    release_cursor(cursor)
     
 try:
     cursor = db_connect(conf['server'], conf['db_name'],
@@ -65,6 +78,11 @@ try:
 except BadConf as e:
     total_exit(logger, timer, 'Не удалось подключиться к БД: '+fmt_ex(e))
 
+# Метаданные таблиц и сведения о дорогах (ось, длина, поверхности) -
+# по одному запросу на запуск, до запуска рабочих процессов
+load_schema_cache(cursor)
+load_road_info(cursor, conf['road_codes'])
+
 # Оценка объёма работы (длина всех дорог)
 try:
     amount = get_amount(cursor, conf['road_codes'])
@@ -73,18 +91,48 @@ except ProcessRoadError as e:
     total_exit(logger, timer, 'Не удалось получить длину дорог: '+fmt_ex(e))
 logger.info('AMOUNT: %d' % amount)
 
-errors_count = 0
-for road_code in conf['road_codes']:
-    # Запуск обработчиков
-    # NOTE: 2 варианта-через сервис acad (API) и старый вариант через схему editor
+# Поток событий о ходе работы
+if conf['progress']:
     try:
-        if conf['acad']:
-            acad_process_road(logger, cursor, conf, road_code)
-        else:
-            process_road(logger, cursor, conf, road_code)
-    except (ProcessRoadError, ProcessError, InvalidInputError) as e:
-        logger.error(fmt_ex(e))
-        errors_count += 1
+        progress.enable(timer, conf,
+                        get_road_lengths(cursor, conf['road_codes']),
+                        [s.name for s in get_stages(conf)])
+    except (OSError, ValueError) as e:
+        total_exit(logger, timer, 'Не удалось открыть поток хода работы: ' +
+                   fmt_ex(e))
+
+# UTM-зона проекта определяется один раз на запуск (если не задана --srid)
+if not conf.get('srid'):
+    conf['srid'] = get_utm(cursor, conf)
+
+# Индекс входных данных (один запрос вместо EXISTS на каждую таблицу) -
+# до запуска рабочих процессов
+load_input_index(cursor, conf['road_codes'])
+
+# Журнал выполненной работы (с --resume - продолжение прерванного запуска)
+try:
+    journal.enable(conf)
+except (OSError, sqlite3.Error) as e:
+    total_exit(logger, timer, 'Не удалось открыть журнал запуска: ' +
+               fmt_ex(e))
+timer.on_exit.append(lambda logger: journal.close())
+
+# Запуск обработчиков
+# NOTE: 2 варианта-через сервис acad (API) и старый вариант через схему editor
+prepare_cursor(cursor, conf['commit'])
+with commit_scope(cursor, conf['commit'], 'run'):
+    if conf['acad']:
+        # Модули acad нужны только этому варианту
+        from common_json import acad_process_road
+        errors_count = run_roads(logger, cursor, conf, acad_process_road)
+    else:
+        errors_count = run_roads(logger, cursor, conf, process_road)
+journal.flush(conf['commit'], 'run')
+incremental.flush(conf['commit'], 'run')
+
+# Планы самых медленных запросов
+if conf['profile_sql'] and conf['profile_sql_explain']:
+    profiling.PROFILER.explain(cursor, conf['profile_sql_explain'])
 
 if errors_count:
     errors = 'Завершено с ошибками (%d)' % errors_count
@@ -5,15 +5,22 @@
 
 import sys
 import optparse
+from concurrent.futures import ThreadPoolExecutor, wait
 
-from conf import BadConf, read_conf, show_conf, db_connect, make_logger
+from conf import BadConf, read_conf, show_conf, db_connect, make_logger, \
+    get_pool, set_pool_size, check_commit_policy, commit_scope, \
+    prepare_cursor, POOL_SIZE
 from common import get_amount
 from helpers import Timer, ask_confirmation, total_exit
+import profiling
+import queries
+from queries import execute, register
 
 # Исключения
 from common import ProcessRoadError
 from calc.helpers import ProcessError
-from validators import InvalidInputError
+from validators import InvalidInputError, load_schema_cache, has_columns, \
+    get_table_meta
 from helpers import fmt_ex
 
 # Исключающие таблицы
@@ -47,6 +54,42 @@ def read_flag_conf():
         action='store', type=str, dest='road_codes',
         help='Код дороги'
     )
+    parser.add_option(
+        '--batch',
+        action='store_true', dest='batch',
+        default=False,
+        help='Обновлять каждую таблицу одним запросом сразу для всех дорог'
+    )
+    parser.add_option(
+        '--parallel',
+        action='store', type=int, dest='parallel',
+        default=1,
+        help='Количество соединений для параллельной обработки таблиц'
+    )
+    parser.add_option(
+        '--profile-sql',
+        action='store_true', dest='profile_sql',
+        default=False,
+        help='Собрать статистику по SQL-запросам'
+    )
+    parser.add_option(
+        '--profile-sql-explain',
+        action='store', type=int, dest='profile_sql_explain',
+        default=0,
+        help='Получить EXPLAIN ANALYZE для N самых медленных запросов'
+    )
+    parser.add_option(
+        '--no-prepare',
+        action='store_true', dest='no_prepare',
+        default=False,
+        help='Не использовать подготовленные операторы (PREPARE/EXECUTE)'
+    )
+    parser.add_option(
+        '--commit',
+        action='store', type=str, dest='commit',
+        help='Политика фиксации транзакций: statement (по умолчанию), '
+             'stage (таблица), road или run'
+    )
     parser.add_option(
         '--layers',
         action='store', type=str, dest='layers',
@@ -62,11 +105,19 @@ def make_conf(options):
     conf = {}
     conf.setdefault('db_name', '')
     conf.setdefault('db_server', '')
+    conf.setdefault('db_user', 'postgres')
+    conf.setdefault('db_pass', 'postgres')
     conf.setdefault('project', '')
     conf.setdefault('logfile', '')
     conf.setdefault('road_codes', [])
     conf.setdefault('layers', '')
     conf.setdefault('quiet', True)
+    conf.setdefault('batch', False)
+    conf.setdefault('parallel', 1)
+    conf.setdefault('commit', 'statement')
+    conf.setdefault('prepared_statements', True)
+    conf.setdefault('profile_sql', False)
+    conf.setdefault('profile_sql_explain', 0)
 
     if options.project:
         conf['db_name'] = 'dorgis_' + options.project
@@ -76,6 +127,21 @@ def make_conf(options):
         conf['logfile'] = options.logfile
     if options.layers:
         conf['layers'] = options.layers
+    if options.batch:
+        conf['batch'] = True
+    if options.parallel < 1:
+        raise BadConf('Количество соединений должно быть не меньше 1')
+    conf['parallel'] = options.parallel
+    if options.profile_sql:
+        conf['profile_sql'] = True
+        conf['profile_sql_explain'] = options.profile_sql_explain
+    if options.no_prepare:
+        conf['prepared_statements'] = False
+    if options.commit:
+        conf['commit'] = check_commit_policy(options.commit)
+    # в пакетном режиме нет деления на дороги
+    if conf['batch'] and conf['commit'] == 'road':
+        conf['commit'] = 'run'
     try:
         conf['road_codes'] = [int(rc) for rc in conf['road_codes']]
     except ValueError:
@@ -90,30 +156,146 @@ def get_table_list(cursor, layers):
     sql_str = """select db_name as table_name, name as title
                 from dorgis.struct_db
                 where schema_name = 'dorgis' and type = 5 
-                and (always_show_all is null or not always_show_all) and db_name not LIKE 'dtp_%'"""
+                and (always_show_all is null or not always_show_all) and db_name not LIKE %(dtp)s"""
+    params = {'dtp': 'dtp_%'}
     
     # исключаем таблицы которые не нужно обновлять, т.к. в них есть ручные данные
     if tbl_not_update:
-        mas_not_update = ["'" +el + "'" for el in tbl_not_update]
-        table_not_layers = ','.join(mas_not_update)
-        str_not_layers = " and db_name not in (%s)" % table_not_layers
-        sql_str = sql_str + str_not_layers
+        sql_str = sql_str + " and db_name <> ALL(%(not_update)s)"
+        params['not_update'] = list(tbl_not_update)
     
     # если в параметре пришёл конкретный список таблиц, то обрабатываем его
     if layers:
-        # преобразуем таблицы к нужному формату запросу
-        s = layers.split(",")
-        mas_layers = ["'" +el + "'" for el in s]
-        table_layers = ','.join(mas_layers)
-        str_layers = " and db_name in (%s)" % table_layers
-        sql_str = sql_str + str_layers
-    cursor.execute(sql_str)
+        sql_str = sql_str + " and db_name = ANY(%(layers)s)"
+        params['layers'] = layers.split(",")
+    cursor.execute(sql_str, params)
     mas_layers = cursor.fetchall()
 
     return mas_layers
 
 
-def update_km(logger, cursor, table_list, road_code):
+def get_update_sql(tbl):
+    """
+    Вернуть SET-часть запроса перепривязки и дополнительное условие
+    для таблицы tbl
+    """
+
+    # есть таблицы в которых км не обновится просто id=id
+    if tbl in ('tbl_contactpoints', 'tbl_autostations', 'tbl_carwashstations', 'tbl_phones', 
+                'tbl_puliccaterings', 'tbl_publictoilets', 'tbl_petrolstations', 'tbl_hotels',
+                'tbl_maintenancestations'):
+        return 'k_s040_1 = null, id=id', ''
+    elif tbl in ('tbl_stationaryweightcontrolposts', 'tbl_borders_attrs'):
+        return 'position = null, id=id', ''
+    #  4.1 Съезды (можно менять только положение лево и право, остальные руками)
+    elif tbl in ('tbl_crossroads'):
+        return 'k_s025_1 = null, id=id', ' and k_s025_1 in (1,2)'
+    else:
+        return 'id=id', ''
+
+
+# Количество объектов дороги в таблице
+SQL_KM_COUNT = register('km_count', """
+    select sum(1)
+    from dorgis.{table}
+    where road_code = %(road_code)s
+""")
+
+# Перепривязка объектов дороги (обновление км выполняет триггер)
+SQL_KM_UPDATE = register('km_update', """
+    update dorgis.{table} SET {set}
+    where road_code = %(road_code)s{cond}
+""")
+
+# Перепривязка объектов сразу всех дорог с количеством по дорогам
+SQL_KM_UPDATE_BATCH = register('km_update_batch', """
+    with upd as (
+        update dorgis.{table} SET {set}
+        where road_code = ANY(%(road_codes)s){cond}
+        returning road_code
+    )
+    select road_code, count(1) as count
+    from upd
+    group by road_code
+    order by road_code
+""")
+
+
+def update_table(logger, cursor, table, road_code):
+    """Перепривязать объекты таблицы table по дороге road_code"""
+
+    tbl = table['table_name']
+    # проверяем существование полей id, road_code (по кэшу метаданных)
+    exist = has_columns(cursor, tbl, ('id', 'road_code'))
+    if exist:
+        execute(cursor, SQL_KM_COUNT, {'road_code': road_code}, table=tbl)
+        count = cursor.fetchone()['sum']
+
+        if count:
+            set_sql, cond_sql = get_update_sql(tbl)
+            execute(cursor, SQL_KM_UPDATE, {'road_code': road_code},
+                    table=tbl, set=set_sql, cond=cond_sql)
+
+            logger.info('Обновлен километраж %d объектов таблицы %s(%s)' % (count, table['title'], tbl))
+
+
+def update_table_batch(logger, cursor, table, road_codes):
+    """
+    Перепривязать объекты таблицы table сразу по всем дорогам road_codes:
+    один UPDATE, количество объектов по дорогам берётся из RETURNING
+    """
+
+    tbl = table['table_name']
+    # проверяем существование полей id, road_code (по кэшу метаданных)
+    if not has_columns(cursor, tbl, ('id', 'road_code')):
+        return
+
+    set_sql, cond_sql = get_update_sql(tbl)
+    execute(cursor, SQL_KM_UPDATE_BATCH, {'road_codes': road_codes},
+            table=tbl, set=set_sql, cond=cond_sql)
+
+    for row in cursor.fetchall():
+        logger.info('Обновлен километраж %d объектов таблицы %s(%s), дорога %d' %
+                    (row['count'], table['title'], tbl, row['road_code']))
+
+
+def run_tables(cursor, table_list, func, pool=None, jobs=1,
+               policy='statement'):
+    """
+    Выполнить func(cursor, table) для всех таблиц.
+    При jobs > 1 таблицы распределяются по jobs соединениям из pool,
+    самые большие (по оценке числа строк) запускаются первыми.
+    Таблица - этап с точки зрения политики фиксации policy.
+    """
+
+    # При фиксации по дороге/запуску все таблицы в одной транзакции
+    if jobs <= 1 or pool is None or policy in ('road', 'run'):
+        for table in table_list:
+            with commit_scope(cursor, policy, 'stage'):
+                func(cursor, table)
+        return
+
+    def table_rows(table):
+        meta = get_table_meta(cursor, table['table_name'])
+        return meta['rows'] if meta else 0
+
+    def work(table):
+        with pool.cursor() as table_cursor:
+            prepare_cursor(table_cursor, policy)
+            with commit_scope(table_cursor, policy, 'stage'):
+                func(table_cursor, table)
+
+    tables = sorted(table_list, key=table_rows, reverse=True)
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(work, table) for table in tables]
+        # дождаться всех таблиц, затем пробросить первую ошибку
+        wait(futures)
+    for future in futures:
+        future.result()
+
+
+def update_km(logger, cursor, table_list, road_code, pool=None, jobs=1,
+              policy='statement'):
     """
     Запустить все указанные в conf обработчики по дороге и
     вернуть ошибку, если что-то пошло не так
@@ -125,63 +307,33 @@ def update_km(logger, cursor, table_list, road_code):
     logger.info('Длина дороги: %d м' % road_len)
     logger.info('Начало обновлений км привязок.')
 
-
-    for table in table_list:
-        tbl = table['table_name']
-        # получаем количество объектов и проверяем существование поля id, road_code
-        sql_sel = """
-            select EXISTS (SELECT column_name
-            FROM information_schema.columns 
-            WHERE table_schema='dorgis' and table_name= '%(table)s' and column_name='id')
-            and 
-            EXISTS (SELECT column_name 
-            FROM information_schema.columns
-            WHERE table_schema='dorgis' and table_name= '%(table)s' and column_name='road_code') as exist
-            """% {'table': tbl, 'road_code': road_code}
-        cursor.execute(sql_sel)
-        exist = cursor.fetchone()['exist']
-
-        if exist:
-            sql_sel = """
-                    select sum(1) 
-                    from dorgis.%(table)s 
-                    where road_code=%(road_code)s
-                """% {'table': tbl, 'road_code': road_code}
-            cursor.execute(sql_sel)
-            count = cursor.fetchone()['sum']
-
-            if count:
-                # есть таблицы в которых км не обновится просто id=id
-                if tbl in ('tbl_contactpoints', 'tbl_autostations', 'tbl_carwashstations', 'tbl_phones', 
-                            'tbl_puliccaterings', 'tbl_publictoilets', 'tbl_petrolstations', 'tbl_hotels',
-                            'tbl_maintenancestations'):
-                    sql_upd = """update dorgis.%(table)s SET k_s040_1 = null, id=id
-                        where road_code = %(road_code)s
-                        """% {'table': tbl, 'road_code': road_code}
-                elif tbl in ('tbl_stationaryweightcontrolposts', 'tbl_borders_attrs'):
-                    sql_upd = """update dorgis.%(table)s SET position = null, id=id
-                        where road_code = %(road_code)s
-                        """% {'table': tbl, 'road_code': road_code}  
-                #  4.1 Съезды (можно менять только положение лево и право, остальные руками)
-                elif tbl in ('tbl_crossroads'):
-                    sql_upd = """update dorgis.%(table)s SET k_s025_1 = null, id=id
-                        where road_code = %(road_code)s and k_s025_1 in (1,2)
-                        """% {'table': tbl, 'road_code': road_code}                     
-                else:
-                    sql_upd = """update dorgis.%(table)s SET id=id
-                        where road_code = %(road_code)s
-                        """% {'table': tbl, 'road_code': road_code}
-                cursor.execute(sql_upd)
-
-                logger.info('Обновлен километраж %d объектов таблицы %s(%s)' % (count, table['title'], tbl))
+    run_tables(cursor, table_list,
+               lambda c, table: update_table(logger, c, table, road_code),
+               pool, jobs, policy)
 
     logger.info('Километраж для объектов дорог %d обновлен.' % road_code)
 
 
+def update_km_batch(logger, cursor, table_list, road_codes, pool=None, jobs=1,
+                    policy='statement'):
+    """Перепривязать объекты сразу всех дорог road_codes"""
+
+    logger.info('Дороги: %s' % ', '.join(str(rc) for rc in road_codes))
+    logger.info('Начало обновлений км привязок.')
+
+    run_tables(cursor, table_list,
+               lambda c, table: update_table_batch(logger, c, table, road_codes),
+               pool, jobs, policy)
+
+    logger.info('Километраж для объектов дорог %s обновлен.' %
+                ', '.join(str(rc) for rc in road_codes))
+
+
 # Парсинг аргументов командной строки
 options, args = read_flag_conf()
 
 conf = make_conf(options)
+queries.configure(conf)
 
 if options.road_codes:
     conf['road_codes'] = options.road_codes.split(',')
@@ -197,7 +349,12 @@ logger = make_logger(conf['logfile'], conf['quiet'])
 # Засечь время
 timer = Timer()
 timer.start()
+if conf['profile_sql']:
+    profiling.enable(timer, conf['logfile'])
      
+# Основное соединение + по одному на каждый параллельный поток
+set_pool_size(POOL_SIZE['min'], max(POOL_SIZE['max'], conf['parallel'] + 1))
+
 try:
     cursor = db_connect(conf['db_server'], conf['db_name'],
                         conf['db_user'], conf['db_pass'])
@@ -212,18 +369,39 @@ except ProcessRoadError as e:
     total_exit(logger, timer, 'Не удалось получить длину дорог: '+fmt_ex(e))
 logger.info('AMOUNT: %d' % amount)
 
+# Метаданные таблиц (один запрос к каталогу на запуск)
+load_schema_cache(cursor)
+
 errors_count = 0
 table_list = get_table_list(cursor, conf['layers'])
 
-if table_list:
-    for road_code in conf['road_codes']:
-        # Запуск обработчиков
-        try:
-            update_km(logger, cursor, table_list, road_code)
-        except (ProcessRoadError, ProcessError, InvalidInputError) as e:
-            logger.error(fmt_ex(e))
-            errors_count += 1
-            errors = 'Завершено с ошибками (%d)' % errors_count
+pool = get_pool(conf['db_server'], conf['db_name'],
+                conf['db_user'], conf['db_pass'])
+
+prepare_cursor(cursor, conf['commit'])
+
+if table_list and conf['batch']:
+    try:
+        with commit_scope(cursor, conf['commit'], 'run'):
+            update_km_batch(logger, cursor, table_list, conf['road_codes'],
+                            pool, conf['parallel'], conf['commit'])
+    except (ProcessRoadError, ProcessError, InvalidInputError) as e:
+        logger.error(fmt_ex(e))
+        errors_count += 1
+        errors = 'Завершено с ошибками (%d)' % errors_count
+
+elif table_list:
+    with commit_scope(cursor, conf['commit'], 'run'):
+        for road_code in conf['road_codes']:
+            # Запуск обработчиков
+            try:
+                with commit_scope(cursor, conf['commit'], 'road'):
+                    update_km(logger, cursor, table_list, road_code,
+                              pool, conf['parallel'], conf['commit'])
+            except (ProcessRoadError, ProcessError, InvalidInputError) as e:
+                logger.error(fmt_ex(e))
+                errors_count += 1
+                errors = 'Завершено с ошибками (%d)' % errors_count
 
 else:    
     logger.info('Выбранные таблицы не найдены в схеме dorgis.')
@@ -233,4 +411,8 @@ else:
 if errors_count == 0:
     errors = None    
 
+# Планы самых медленных запросов
+if conf['profile_sql'] and conf['profile_sql_explain']:
+    profiling.PROFILER.explain(cursor, conf['profile_sql_explain'])
+
 total_exit(logger, timer, errors)
\ No newline at end of file
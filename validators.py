@@ -2,89 +2,264 @@
 Валидаторы для работы импорта
 """
 
+from queries import execute, register
+
 
 class InvalidInputError(Exception):
     """Исключение для проверки входных данных"""
     pass
 
 
+# Кэш метаданных таблиц схем dorgis и public:
+# (schema, table) -> {'columns': множество полей, 'rows': оценка числа строк}
+# Загружается одним запросом к pg_class/pg_attribute вместо запросов
+# к information_schema на каждую таблицу
+SCHEMA_CACHE_SCHEMAS = ['dorgis', 'public']
+_schema_cache = {'loaded': False, 'tables': {}}
+
+
+def load_schema_cache(cursor):
+    """Загрузить метаданные таблиц одним запросом к каталогу"""
+
+    sql = '''
+        SELECT n.nspname AS schema_name, c.relname AS table_name,
+               c.reltuples::bigint AS rows,
+               array_agg(a.attname::text) AS columns
+        FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        LEFT JOIN pg_attribute a ON a.attrelid = c.oid
+            AND a.attnum > 0 AND NOT a.attisdropped
+        WHERE n.nspname = ANY(%(schemas)s)
+            AND c.relkind IN ('r', 'v', 'm', 'f', 'p')
+        GROUP BY n.nspname, c.relname, c.reltuples
+    '''
+    cursor.execute(sql, {'schemas': SCHEMA_CACHE_SCHEMAS})
+
+    tables = {}
+    for row in cursor.fetchall():
+        tables[(row['schema_name'], row['table_name'])] = {
+            'columns': set(c for c in row['columns'] if c),
+            'rows': max(row['rows'], 0)
+        }
+    _schema_cache['tables'] = tables
+    _schema_cache['loaded'] = True
+
+
+def reset_schema_cache():
+    """Сбросить кэш метаданных"""
+    _schema_cache['loaded'] = False
+    _schema_cache['tables'] = {}
+
+
+def get_table_meta(cursor, table, schema='dorgis'):
+    """Метаданные таблицы из кэша (None, если таблицы нет)"""
+    if not _schema_cache['loaded']:
+        load_schema_cache(cursor)
+    return _schema_cache['tables'].get((schema, table))
+
+
+def has_columns(cursor, table, columns, schema='dorgis'):
+    """Проверить, что таблица существует и в ней есть все поля columns"""
+    meta = get_table_meta(cursor, table, schema)
+    if not meta:
+        return False
+    return all(column in meta['columns'] for column in columns)
+
+
 def check_road(cursor, road_code):
     """Проверить, существует ли ось дороги"""
 
+    return get_road_info(cursor, road_code).has_axis
+
+
+def check_tins(cursor, road_code):
+    """Проверить поверхности для данной дороги"""
+
+    return get_road_info(cursor, road_code).has_tins
+
+
+def check_table(cursor, table):
+    """Проверить, существует ли таблица в схеме dorgis"""
+
+    return get_table_meta(cursor, table) is not None
+
+
+class RoadInfo(object):
+    """Сведения о дороге для проверок и оценки объёма работы"""
+
+    __slots__ = ('road_code', 'has_axis', 'length', 'fmp', 'tmp', 'name',
+                 'has_tins', 'fnames')
+
+    def __init__(self, road_code, has_axis, length, fmp, tmp, name,
+                 has_tins, fnames):
+        self.road_code = road_code
+        # Есть ли ось в tbl_roads
+        self.has_axis = has_axis
+        # Длина, м (None, если не заполнено length_km)
+        self.length = length
+        # Начало и конец дороги, км
+        self.fmp = fmp
+        self.tmp = tmp
+        self.name = name
+        # Есть ли поверхности по потокам дороги
+        self.has_tins = has_tins
+        # Потоки дороги (tbl_fname_road_code)
+        self.fnames = fnames
+
+
+# Сведения о дорогах: road_code -> RoadInfo. Загружаются одним запросом
+# на все дороги запуска (load_road_info) до запуска рабочих процессов
+_road_info = {}
+
+
+def load_road_info(cursor, road_codes):
+    """
+    Загрузить сведения о дорогах road_codes одним запросом,
+    вернуть словарь road_code -> RoadInfo
+    """
+
+    # Без таблицы поверхностей у дорог нет поверхностей
+    if get_table_meta(cursor, 'tbl_las_tin', 'public'):
+        tins_sql = '''
+            EXISTS (
+                SELECT 1 FROM tbl_las_tin WHERE fname = ANY(f.fnames)
+            )'''
+    else:
+        tins_sql = 'false'
+
     sql = '''
-        SELECT EXISTS (
-            SELECT 1
+        SELECT rc AS road_code, r.n > 0 AS has_axis,
+               r.length_km*1000 AS length, r.fmp, r.tmp, r.name,
+               coalesce(f.fnames, '{}') AS fnames,
+               %s AS has_tins
+        FROM unnest(%%(road_codes)s::int[]) AS rc
+        CROSS JOIN LATERAL (
+            SELECT count(1) AS n, sum(length_km) AS length_km,
+                   min(fmp) AS fmp, max(tmp) AS tmp, min(name) AS name
             FROM tbl_roads
-            WHERE road_code = %d
-        )
-    ''' % road_code
-    cursor.execute(sql)
-    res = cursor.fetchone()['exists']
+            WHERE road_code = rc
+        ) r
+        CROSS JOIN LATERAL (
+            SELECT array_agg(fname::text ORDER BY fname) AS fnames
+            FROM tbl_fname_road_code
+            WHERE road_code = rc
+        ) f
+    ''' % tins_sql
+    cursor.execute(sql, {'road_codes': [int(rc) for rc in road_codes]})
 
-    return res
+    infos = {}
+    for row in cursor.fetchall():
+        infos[row['road_code']] = RoadInfo(
+            row['road_code'], row['has_axis'],
+            int(row['length']) if row['length'] is not None else None,
+            row['fmp'], row['tmp'], row['name'], row['has_tins'],
+            tuple(row['fnames']))
+    _road_info.update(infos)
+    return infos
 
 
-def check_tins(cursor, road_code):
-    """Проверить поверхности для данной дороги"""
+def reset_road_info():
+    """Сбросить сведения о дорогах"""
+    _road_info.clear()
+
+
+def get_road_infos(cursor, road_codes):
+    """Сведения о дорогах (недостающие загружаются одним запросом)"""
+    missing = [rc for rc in road_codes if rc not in _road_info]
+    if missing:
+        load_road_info(cursor, missing)
+    return [_road_info[rc] for rc in road_codes]
+
+
+def get_road_info(cursor, road_code):
+    """Сведения о дороге"""
+    return get_road_infos(cursor, [road_code])[0]
+
+
+# Индекс входных данных: пары (road_code, table_name) из
+# editor.tbl_acad_objects. Загружается один раз на запуск
+# (load_input_index), чтобы не делать EXISTS-запрос на каждую таблицу
+_input_index = {'roads': None, 'pairs': None}
+
+
+def load_input_index(cursor, road_codes=None):
+    """Загрузить индекс входных данных одним запросом"""
+
+    reset_input_index()
+
+    # Без схемы editor индекс не нужен, проверки работают как раньше
+    cursor.execute("SELECT to_regclass('editor.tbl_acad_objects') AS reg")
+    if not cursor.fetchone()['reg']:
+        return
 
-    # Проверка существования таблицы tbl_las_tin
     sql = '''
-        SELECT EXISTS (
-            SELECT 1
-            FROM information_schema.tables
-            WHERE table_schema = 'public' AND table_name = 'tbl_las_tin'
-        )
+        SELECT DISTINCT road_code, table_name
+        FROM editor.tbl_acad_objects
     '''
-    cursor.execute(sql)
-    res = cursor.fetchone()['exists']
-    if not res:
-        return False
+    params = {}
+    if road_codes:
+        sql += '''
+        WHERE road_code::text = ANY(%(road_codes)s)
+        '''
+        params['road_codes'] = [str(rc) for rc in road_codes]
+    cursor.execute(sql, params)
 
-    # Проверка существования поверхностей по потокам данной дороги
-    sql = '''
-        SELECT EXISTS (
-            SELECT 1
-            FROM tbl_las_tin
-            WHERE fname IN (
-                SELECT fname FROM tbl_fname_road_code WHERE road_code = %d
-            )
-            LIMIT 1
-        )
-    ''' % road_code
-    cursor.execute(sql)
-    res = cursor.fetchone()['exists']
-    if not res:
-        return False
+    _input_index['pairs'] = set(
+        (str(row['road_code']), row['table_name'])
+        for row in cursor.fetchall()
+    )
+    if road_codes:
+        _input_index['roads'] = set(str(rc) for rc in road_codes)
+    else:
+        _input_index['roads'] = None
 
-    return True
 
+def reset_input_index():
+    """Сбросить индекс входных данных"""
+    _input_index['roads'] = None
+    _input_index['pairs'] = None
 
-def check_table(cursor, table):
-    """Проверить, существует ли таблица в схеме dorgis"""
 
-    sql = '''
-        SELECT EXISTS (
-            SELECT 1
-            FROM information_schema.tables
-            WHERE table_schema = 'dorgis' AND table_name = '%s'
-        )
-    ''' % table
-    cursor.execute(sql)
-    res = cursor.fetchone()['exists']
+def get_input_tables():
+    """Имена таблиц из индекса входных данных (None, если не загружен)"""
+    if _input_index['pairs'] is None:
+        return None
+    return sorted(set(table for road_code, table in _input_index['pairs']))
+
+
+def _input_index_lookup(road_code, table):
+    """
+    Ответить по индексу, есть ли входные данные.
+    None - индекс не загружен или не покрывает дорогу.
+    """
+    if _input_index['pairs'] is None:
+        return None
+    road_code = str(road_code)
+    if _input_index['roads'] is not None and \
+            road_code not in _input_index['roads']:
+        return None
+    return (road_code, table) in _input_index['pairs']
+
+
+# Есть ли входные данные дороги для таблицы (если индекс не загружен)
+SQL_INPUT_EXISTS = register('input_exists', '''
+    SELECT EXISTS (
+        SELECT 1
+        FROM editor.tbl_acad_objects
+        WHERE road_code = %(road_code)s AND table_name = %(table)s
+    )
+''')
 
-    return res
 
 def acad_check_input_data(cursor, road_code, table):
     """Проверить, есть ли данные для импорта в таблицу"""
 
-    sql = '''
-        SELECT EXISTS (
-            SELECT 1
-            FROM editor.tbl_acad_objects
-            WHERE road_code = '%s' AND table_name = '%s'
-        )
-    ''' % (road_code, table)
-    cursor.execute(sql)
+    res = _input_index_lookup(road_code, table)
+    if res is not None:
+        return res
+
+    execute(cursor, SQL_INPUT_EXISTS,
+            {'road_code': str(road_code), 'table': table})
     res = cursor.fetchone()['exists']
 
     return res
@@ -93,14 +268,12 @@ def acad_check_input_data(cursor, road_code, table):
 def check_input_data(cursor, road_code, table):
     """Проверить, есть ли данные для импорта в таблицу"""
 
-    sql = '''
-        SELECT EXISTS (
-            SELECT 1
-            FROM editor.tbl_acad_objects
-            WHERE road_code = '%s' AND table_name = '%s'
-        )
-    ''' % (road_code, table)
-    cursor.execute(sql)
+    res = _input_index_lookup(road_code, table)
+    if res is not None:
+        return res
+
+    execute(cursor, SQL_INPUT_EXISTS,
+            {'road_code': str(road_code), 'table': table})
     res = cursor.fetchone()['exists']
 
     return res